@@ -0,0 +1,149 @@
+import time
+
+
+# Seconds of history the temperature and humidity slopes are fitted over
+SLOPE_WINDOW = 30*60
+# Fewer samples than this in the window give no slope
+MIN_SLOPE_SAMPLES = 3
+
+# Magnus formula coefficients over water, temperatures in C
+MAGNUS_A = 17.27
+MAGNUS_B = 237.3
+# Saturation vapor pressure at 0 C in kPa
+MAGNUS_P0 = 0.6108
+
+
+def fahrenheitToCelsius(t):
+    return (t - 32)*5/9.0
+
+
+def celsiusToFahrenheit(t):
+    return t*9/5.0 + 32
+
+
+def saturationPressure(temp_c):
+    # kPa
+    import numpy as np
+    return MAGNUS_P0*np.exp(MAGNUS_A*temp_c/(temp_c + MAGNUS_B))
+
+
+def dewPoint(temp_f, humidity):
+    """
+    Dew point in F for arrays of temperatures in F and relative humidity
+    in percent.
+    """
+    import numpy as np
+    temp_c = fahrenheitToCelsius(temp_f)
+    gamma = np.log(np.clip(humidity, 1, 100)/100.0) + MAGNUS_A*temp_c/(temp_c + MAGNUS_B)
+    return celsiusToFahrenheit(MAGNUS_B*gamma/(MAGNUS_A - gamma))
+
+
+def vaporPressureDeficit(temp_f, humidity):
+    """
+    Vapor pressure deficit in kPa, how much more water the air could hold.
+    """
+    saturation = saturationPressure(fahrenheitToCelsius(temp_f))
+    return saturation*(1 - humidity/100.0)
+
+
+def slopes(times, values, mask):
+    """
+    Least squares slope per hour of every row of values against times.
+    mask marks the real samples, the others can be anything, nan included.
+    Rows with fewer than MIN_SLOPE_SAMPLES samples get nan.
+    """
+    import numpy as np
+    times = np.where(mask, times, 0)
+    values = np.where(mask, values, 0)
+    count = mask.sum(axis=1)
+    n = np.maximum(count, 1)
+    t_mean = (times*mask).sum(axis=1)/n
+    v_mean = (values*mask).sum(axis=1)/n
+    dt = (times - t_mean[:, None])*mask
+    dv = (values - v_mean[:, None])*mask
+    var = (dt*dt).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = 3600*(dt*dv).sum(axis=1)/var
+    slope[(count < MIN_SLOPE_SAMPLES) | (var == 0)] = np.nan
+    return slope
+
+
+class Analysis(object):
+    """
+    Drying analytics of every sensor in the history. Every attribute but
+    Sensors and Time is an array in the order of Sensors, nan where there
+    isn't enough data, e.g. for a sensor without a humidity reading.
+    """
+    def __init__(self, t, sensors, temp, humidity, dew_point, vpd, temp_slope, humidity_slope):
+        self.Time = t
+        self.Sensors = sensors
+        self.Temp = temp
+        self.Humidity = humidity
+        self.DewPoint = dew_point
+        self.VPD = vpd
+        self.TempSlope = temp_slope
+        self.HumiditySlope = humidity_slope
+
+    def get(self, sensor):
+        # {quantity: value} of one sensor or None
+        if sensor not in self.Sensors:
+            return None
+        i = self.Sensors.index(sensor)
+        return {
+            "dew_point": float(self.DewPoint[i]),
+            "vpd": float(self.VPD[i]),
+            "temp_slope": float(self.TempSlope[i]),
+            "humidity_slope": float(self.HumiditySlope[i]),
+        }
+
+
+class Analyzer(object):
+    """
+    Computes an Analysis from a history.History after each data refresh
+    that added readings. Runs on the data thread. The history keeps every
+    sensor in the same row of each measurement's table, so the math works on
+    slices of the tables for all sensors at once.
+    """
+    def __init__(self, history, window=SLOPE_WINDOW):
+        self.History = history
+        self.Window = window
+        self.LastUpdate = None
+        self.Latest = None
+
+    def gather(self, table, rows, since):
+        # (times, values, mask) of the first rows' readings since, times
+        # relative to since to keep precision
+        times, values = table.since(since)
+        times, values = times[:rows], values[:rows]
+        # nan compares False, refreshes without a reading drop out
+        return times - since, values, times >= since
+
+    def update(self, now=None):
+        """
+        The new Analysis, or None if nothing was added to the history since
+        the last one.
+        """
+        if self.History.Updates == self.LastUpdate:
+            return None
+        self.LastUpdate = self.History.Updates
+        if now is None:
+            now = time.time()
+
+        temps = self.History.table("temperature")
+        humidities = self.History.table("humidity")
+        if temps is None or humidities is None:
+            return None
+        sensors = list(self.History.Sensors)
+        rows = len(sensors)
+        temp = temps.last()[1][:rows].copy()
+        humidity = humidities.last()[1][:rows].copy()
+
+        since = now - self.Window
+        temp_slope = slopes(*self.gather(temps, rows, since))
+        humidity_slope = slopes(*self.gather(humidities, rows, since))
+
+        self.Latest = Analysis(now, sensors, temp, humidity,
+                               dewPoint(temp, humidity),
+                               vaporPressureDeficit(temp, humidity),
+                               temp_slope, humidity_slope)
+        return self.Latest
@@ -0,0 +1,112 @@
+import concurrent.futures
+import glob
+import os
+import threading
+
+import pygame
+
+
+WARM_WORKERS = 4
+
+_Lock = threading.Lock()
+_Images = {}
+_Converted = {}
+_Fonts = {}
+_Pending = {}
+
+
+def imageFiles(directory):
+    return sorted(glob.glob(os.path.join(directory, "*.png")))
+
+
+def _wait(key):
+    # Wait for a background load of key started by warm()
+    with _Lock:
+        future = _Pending.get(key)
+    if future is not None:
+        future.result()
+
+
+def _loadImage(path):
+    with _Lock:
+        image = _Images.get(path)
+    if image is None:
+        image = pygame.image.load(path)
+        with _Lock:
+            image = _Images.setdefault(path, image)
+    return image
+
+
+def loadImage(path):
+    """
+    The decoded image at path, loaded once per process. The surface is shared
+    so it must not be drawn on.
+    """
+    _wait(path)
+    return _loadImage(path)
+
+
+def image(path, alpha=True):
+    """
+    The image at path converted to the display format, once per process. Falls
+    back to the unconverted image if the display is not set up yet.
+    """
+    key = (path, alpha)
+    converted = _Converted.get(key)
+    if converted is not None:
+        return converted
+
+    loaded = loadImage(path)
+    if pygame.display.get_surface() is None:
+        return loaded
+
+    if alpha:
+        converted = loaded.convert_alpha()
+    else:
+        converted = loaded.convert()
+    _Converted[key] = converted
+    return converted
+
+
+def _loadFont(name, size):
+    key = (name, size)
+    with _Lock:
+        f = _Fonts.get(key)
+    if f is None:
+        f = pygame.font.SysFont(name, size)
+        with _Lock:
+            f = _Fonts.setdefault(key, f)
+    return f
+
+
+def _loadFonts(fonts):
+    # FreeType is not thread safe, so all fonts load on one worker
+    for name, size in fonts:
+        _loadFont(name, size)
+
+
+def font(name, size):
+    """
+    The system font name at size, looked up once per process.
+    """
+    _wait((name, size))
+    return _loadFont(name, size)
+
+
+def warm(paths, fonts=(), workers=WARM_WORKERS):
+    """
+    Start loading images and fonts in the background. Later calls for them
+    wait for the load instead of starting another one. Fonts need
+    pygame.font to be initialized.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    with _Lock:
+        for path in paths:
+            if path not in _Images and path not in _Pending:
+                _Pending[path] = executor.submit(_loadImage, path)
+        fonts = [f for f in fonts if f not in _Fonts and f not in _Pending]
+        if fonts:
+            future = executor.submit(_loadFonts, fonts)
+            for f in fonts:
+                _Pending[f] = future
+    executor.shutdown(wait=False)
@@ -0,0 +1,300 @@
+#! /usr/bin/env python3
+"""
+Headless GUI benchmark.
+
+Runs gui.App on SDL's dummy video driver with FakeDMX and a stubbed
+data.DataSource, replays scripted touch sequences and reports frames/sec,
+CPU time per frame, allocations per frame and DMX/config writes per second.
+With --dmx-sim the DMX output goes through the serial path to a dmxsim.py
+pty instead of FakeDMX, and the frames and bytes it received are reported.
+
+    python3 bench.py --output before.json
+    python3 bench.py --compare before.json
+    DMX_REFRESH_RATE=200 python3 bench.py --dmx-sim --wire
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ.pop("PRODUCTION", None)
+
+import pygame
+from pygame.locals import *
+
+# Local imports
+import control
+import data
+import dmxsim
+import gui
+
+
+FRAMES = 300
+WARMUP_FRAMES = 20
+ALLOC_FRAMES = 100
+TOLERANCE = 20
+# Seconds the DMX output and config writes are sampled for. Both run on their
+# own clocks, the scripted frames alone can be over in milliseconds.
+SAMPLE_TIME = 2.0
+
+# Metrics where a higher value is a regression, everything else is fps like
+LOWER_IS_BETTER = ("cpu_ms_per_frame", "alloc_bytes_per_frame", "net_blocks_per_frame",
+                   "config_writes_per_sec", "sim_errors")
+
+SENSORS = ["internal1", "internal2", "internal3",
+           "duct4", "duct5", "duct6", "duct7", "duct8",
+           "outdoor9"]
+
+
+class StubDataSource(object):
+    """
+    Stands in for data.DataSource, returns readings that change on every call
+    without touching the network.
+    """
+    def __init__(self, log):
+        self.Log = log
+        self.Calls = 0
+
+    def readingTimes(self):
+        return {}
+
+    def backlog(self):
+        return 0, 0
+
+    def queryCurrent(self):
+        self.Calls += 1
+        return {
+            "temperature": dict((s, 70 + (self.Calls + i) % 10) for i, s in enumerate(SENSORS)),
+            "humidity": dict((s, 40 + (self.Calls + i) % 20) for i, s in enumerate(SENSORS)),
+        }
+
+
+#
+# Scripted input
+#
+def tap(pos):
+    return [pygame.event.Event(MOUSEBUTTONDOWN, pos=pos, button=1),
+            pygame.event.Event(MOUSEBUTTONUP, pos=pos, button=1)]
+
+
+def offset(rect, position):
+    return (int(rect.centerx + position[0]), int(rect.centery + position[1]))
+
+
+def idleMain(app, frame):
+    return []
+
+
+def toggleSettings(app, frame):
+    if app.InSettings:
+        return tap(app.ControlPanel.ReturnButton.Rect.center)
+    return tap(app.SettingsButton.Rect.center)
+
+
+def dragManifold(app, frame):
+    manifold = app.ControlPanel.ManifoldControl
+    if frame == 0:
+        pos = offset(manifold.Dot, manifold.Position)
+        return [pygame.event.Event(MOUSEBUTTONDOWN, pos=pos, button=1)]
+
+    # Sweep the slider up and down its whole travel
+    travel = manifold.BottomLimitY - manifold.TopLimitY
+    step = (frame * 5) % (2*travel)
+    y = manifold.TopLimitY + (step if step < travel else 2*travel - step)
+    pos = (int(manifold.Position[0] + manifold.Size[0] - 30), int(manifold.Position[1] + y))
+    return [pygame.event.Event(MOUSEMOTION, pos=pos, rel=(0, 5), buttons=(1, 0, 0))]
+
+
+def hammerBlower(app, frame):
+    blower = app.ControlPanel.BlowerControl
+    if (frame // 10) % 2 == 0:
+        button = blower.UpButton
+    else:
+        button = blower.DownButton
+    return tap(offset(button.Rect, blower.Position))
+
+
+# name: (starts in settings, input for a frame)
+SCENARIOS = {
+    "idle_main": (False, idleMain),
+    "toggle_settings": (False, toggleSettings),
+    "drag_manifold": (True, dragManifold),
+    "hammer_blower": (True, hammerBlower),
+}
+SCENARIO_ORDER = ["idle_main", "toggle_settings", "drag_manifold", "hammer_blower"]
+
+
+def setup(config_dir, sim=None):
+    # Keep the benchmark away from the real config and InfluxDB
+    control.CONFIG_FILE = os.path.join(config_dir, "dmx.config")
+    control.DMX_STATS_FILE = os.path.join(config_dir, "dmx.stats")
+    if sim is not None:
+        control.DMX_PORT = sim.Port
+    with open(control.CONFIG_FILE, "w") as f:
+        json.dump({control.LOWER_DAMPER: 255,
+                   control.UPPER_DAMPER: 255,
+                   control.BLOWER_VFD: 0,
+                   control.EXHAUST_DAMPER: 0}, f)
+    data.DataSource = StubDataSource
+
+    log = logging.getLogger("DryerBenchLogger")
+    log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.WARNING)
+    app = gui.App(log)
+
+    # Start a drying run so control changes are sent to the DMX interface
+    app.step([])
+    app.StartStop.handleClick(app.StartStop.Rect.center)
+    return app
+
+
+def runScenario(app, name, frames, sim=None):
+    in_settings, script = SCENARIOS[name]
+    if app.InSettings != in_settings:
+        app.handleSettings()
+    app.LastMovement = time.time()
+
+    frame = 0
+    for i in range(WARMUP_FRAMES):
+        app.step(script(app, frame))
+        frame += 1
+
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    for i in range(frames):
+        app.step(script(app, frame))
+        frame += 1
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+
+    # Separate pass at the input rate of the real loop, the output thread
+    # and the config store are measured over wall time
+    dmx = app.ControlPanel.Dmx
+    dmx_frames = sum(o.Stats.Frames for o in dmx.Outputs.values())
+    config_writes = dmx.Store.Writes
+    if sim is not None:
+        sim_stats = sim.snapshot()
+    sample = time.perf_counter()
+    while time.perf_counter() - sample < SAMPLE_TIME:
+        app.step(script(app, frame))
+        frame += 1
+        time.sleep(gui.INPUT_POLL_INTERVAL)
+    sample = time.perf_counter() - sample
+    dmx_frames = sum(o.Stats.Frames for o in dmx.Outputs.values()) - dmx_frames
+    config_writes = dmx.Store.Writes - config_writes
+    if sim is not None:
+        previous = sim_stats
+        sim_stats = sim.snapshot()
+        for k in ("frames", "bytes", "errors"):
+            sim_stats[k] -= previous[k]
+
+    # Separate pass, tracing slows everything down. Only allocations made
+    # by Python are seen, not SDL's pixel buffers.
+    alloc_bytes = 0
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    for i in range(ALLOC_FRAMES):
+        tracemalloc.reset_peak()
+        current, peak = tracemalloc.get_traced_memory()
+        app.step(script(app, frame))
+        frame += 1
+        alloc_bytes += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks
+
+    results = {
+        "frames": frames,
+        "fps": frames/wall if wall else 0.0,
+        "cpu_ms_per_frame": 1000.0*cpu/frames,
+        "alloc_bytes_per_frame": float(alloc_bytes)/ALLOC_FRAMES,
+        "net_blocks_per_frame": float(blocks)/ALLOC_FRAMES,
+        "dmx_frames_per_sec": dmx_frames/sample,
+        "config_writes_per_sec": config_writes/sample,
+    }
+    if sim is not None:
+        results["sim_frames_per_sec"] = sim_stats["frames"]/sample
+        results["sim_bytes_per_sec"] = sim_stats["bytes"]/sample
+        results["sim_errors"] = sim_stats["errors"]
+    return results
+
+
+def compare(old, new, tolerance):
+    # Print the change of every metric, returns the number of regressions
+    regressions = 0
+    for name, results in sorted(new["scenarios"].items()):
+        previous = old.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        print(name)
+        for metric, value in sorted(results.items()):
+            before = previous.get(metric)
+            if before is None or metric == "frames":
+                continue
+            change = 100.0*(value - before)/before if before else 0.0
+            if metric in LOWER_IS_BETTER:
+                worse = change > tolerance and value - before > 0.01
+            else:
+                worse = change < -tolerance
+            regressions += worse
+            print("    %-22s %12.3f -> %12.3f  %+7.1f%%%s"%(metric, before, value, change,
+                                                          "  REGRESSION" if worse else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless dryer GUI benchmark")
+    parser.add_argument("--frames", type=int, default=FRAMES)
+    parser.add_argument("--scenario", action="append", choices=SCENARIO_ORDER,
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="percent change that counts as a regression")
+    parser.add_argument("--dmx-sim", action="store_true",
+                        help="send DMX to a simulated Enttec interface")
+    parser.add_argument("--wire", action="store_true",
+                        help="limit the simulated interface to the DMX line rate")
+    args = parser.parse_args()
+
+    sim = None
+    if args.dmx_sim:
+        sim = dmxsim.EnttecSimulator(rate=dmxsim.DMX_WIRE_RATE if args.wire else None)
+
+    scenarios = {}
+    with tempfile.TemporaryDirectory() as config_dir:
+        # FakeDMX prints every frame with changes
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            app = setup(config_dir, sim)
+            for name in args.scenario or SCENARIO_ORDER:
+                scenarios[name] = runScenario(app, name, args.frames, sim)
+            app.shutdown()
+    if sim is not None:
+        sim.close()
+
+    results = {
+        "time": datetime.datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "pygame": pygame.version.ver,
+        "scenarios": scenarios,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+    else:
+        print(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
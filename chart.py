@@ -0,0 +1,219 @@
+import math
+import pygame
+from pygame.locals import *
+import time
+
+# Local imports
+import widgets
+
+
+# Hours of history the chart can show, tapping the chart cycles through them
+CHART_HOURS = (6, 12, 24, 48)
+PLOT_RECT = (60, 60, 680, 370)
+TEMP_COLOR = (200, 60, 40)
+# Baseline of the analytics line below the axis labels
+ANALYSIS_Y = 474
+HUMIDITY_COLOR = (40, 90, 200)
+AXIS_TICKS = 5
+
+
+def lttb(x, y, threshold):
+    """
+    Largest triangle three buckets downsampling of the series x, y to
+    threshold points, keeping the points that shape the line. numpy arrays
+    in, numpy arrays out.
+    """
+    import numpy as np
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    keep = np.empty(threshold, dtype=np.intp)
+    keep[0] = 0
+    keep[-1] = n - 1
+    # Bucket edges for the points between the first and the last
+    edges = (np.arange(threshold - 1)*(n - 2)/(threshold - 2)).astype(np.intp) + 1
+    edges[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket, the last point for the last bucket
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # Twice the triangle areas, the constant factor doesn't matter
+        areas = np.abs((x[a] - next_x)*(y[start:end] - y[a]) -
+                       (x[a] - x[start:end])*(next_y - y[a]))
+        a = start + int(areas.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
+
+
+def formatAnalysis(analysis):
+    # One line of text from an analytics.Analysis.get() dict
+    def value(key, format):
+        v = analysis[key]
+        return "--" if math.isnan(v) else format%v
+    return "Dew point %s   VPD %s   Temp %s   Humidity %s"%(
+        value("dew_point", "%.0f F"), value("vpd", "%.2f kPa"),
+        value("temp_slope", "%+.1f F/h"), value("humidity_slope", "%+.1f %%/h"))
+
+
+def axisRange(values):
+    # (low, high) with some room around the line
+    if not len(values):
+        return -1.0, 1.0
+    low, high = float(values.min()), float(values.max())
+    if high - low < 1:
+        low, high = low - 1, high + 1
+    pad = (high - low)*0.1
+    return low - pad, high + pad
+
+
+class ChartScreen(object):
+    """
+    History of one sensor's temperature and humidity. The data is fetched
+    off the UI thread through fetch_handler(sensor, hours), which reports
+    back with setData(). The chart is drawn once per data set into a cached
+    surface, render() only blits it after events. Below it goes the drying
+    analytics of the sensor from analysis_handler(sensor), a dict as from
+    analytics.Analysis.get() or None.
+    """
+    def __init__(self, log, screen, return_handler, fetch_handler, analysis_handler=None):
+        self.Log = log
+        self.Screen = screen
+        self.Size = self.Screen.get_size()
+        self.ReturnHandler = return_handler
+        self.FetchHandler = fetch_handler
+        self.AnalysisHandler = analysis_handler
+        self.PlotRect = pygame.Rect(PLOT_RECT)
+
+        self.Sensor = None
+        self.Hours = CHART_HOURS[1]
+        self.Status = None
+        self.Chart = None
+        self.Dirty = True
+
+        self.ReturnButton = widgets.ReturnButton((self.Size[0]-55, 5), self.handleReturn)
+        self.Background = pygame.surface.Surface(self.Size).convert()
+        self.Background.fill(widgets.WHITE)
+        self.ReturnButton.render(self.Background)
+
+    def show(self, sensor):
+        if sensor != self.Sensor:
+            self.Chart = None
+        self.Sensor = sensor
+        self.refresh()
+
+    def refresh(self):
+        # Ask for new data, the current chart stays up until it arrives
+        if self.Chart is None:
+            self.Status = "Loading..."
+        self.FetchHandler(self.Sensor, self.Hours)
+        self.invalidate()
+
+    def setData(self, sensor, hours, history, error=None):
+        if sensor != self.Sensor or hours != self.Hours:
+            # Answer to an older request
+            return
+        if error is not None:
+            self.Status = "No data: %s"%error
+        else:
+            self.Status = None
+            self.Chart = self.draw(history)
+            if self.Chart is None:
+                self.Status = "No data"
+        self.invalidate()
+
+    def invalidate(self):
+        self.Dirty = True
+
+    def handleReturn(self):
+        self.ReturnHandler()
+
+    def handleEvent(self, event):
+        if event.type != MOUSEBUTTONDOWN:
+            return False
+        if self.ReturnButton.handleClick(event.pos):
+            return True
+        if self.PlotRect.collidepoint(event.pos):
+            self.Hours = CHART_HOURS[(CHART_HOURS.index(self.Hours) + 1) % len(CHART_HOURS)]
+            self.Chart = None
+            self.refresh()
+            return True
+        return False
+
+    def plotPoints(self, x, y, x_range, y_range):
+        # Screen coordinates of a series, downsampled to one point per pixel
+        x, y = lttb(x, y, self.PlotRect.width)
+        rect = self.PlotRect
+        xs = rect.left + (x - x_range[0])*(rect.width - 1)/(x_range[1] - x_range[0])
+        ys = rect.bottom - 1 - (y - y_range[0])*(rect.height - 1)/(y_range[1] - y_range[0])
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    def draw(self, history):
+        # The chart as a transparent surface or None without any data
+        import numpy as np
+        series = []
+        for name, color in (("temperature", TEMP_COLOR), ("humidity", HUMIDITY_COLOR)):
+            times, values = history.get(name, ([], []))
+            if len(times) > 1:
+                series.append((name, color, np.asarray(times, dtype=float), np.asarray(values, dtype=float)))
+        if not series:
+            return None
+
+        surface = pygame.surface.Surface(self.Size, pygame.SRCALPHA)
+        rect = self.PlotRect
+        pygame.draw.rect(surface, widgets.GREY, rect, 1)
+
+        now = time.time()
+        x_range = (now - self.Hours*3600, now)
+        for i in range(AXIS_TICKS + 1):
+            x = rect.left + i*(rect.width - 1)//AXIS_TICKS
+            pygame.draw.line(surface, widgets.GREY, (x, rect.top), (x, rect.bottom - 1))
+            label = widgets.renderText("-%gh"%(self.Hours*(AXIS_TICKS - i)/float(AXIS_TICKS)), 16)
+            surface.blit(label, label.get_rect(midtop=(x, rect.bottom + 4)))
+
+        for name, color, x, y in series:
+            y_range = axisRange(y)
+            points = self.plotPoints(x, y, x_range, y_range)
+            pygame.draw.lines(surface, color, False, points, 2)
+
+            # Temperature scale on the left, humidity on the right
+            unit = "F" if name == "temperature" else "%"
+            for i in range(AXIS_TICKS + 1):
+                value = y_range[0] + i*(y_range[1] - y_range[0])/AXIS_TICKS
+                label = widgets.renderText("%.0f %s"%(value, unit), 16, color)
+                ly = rect.bottom - 1 - i*(rect.height - 1)//AXIS_TICKS
+                if name == "temperature":
+                    surface.blit(label, label.get_rect(midright=(rect.left - 4, ly)))
+                else:
+                    surface.blit(label, label.get_rect(midleft=(rect.right + 4, ly)))
+        return surface
+
+    def render(self):
+        if not self.Dirty:
+            return False
+        self.Dirty = False
+
+        self.Screen.blit(self.Background, (0,0))
+        title = "%s, last %d hours"%(self.Sensor, self.Hours)
+        self.Screen.blit(widgets.renderText(title, 20), (10, 15))
+        legend = widgets.renderText("Temperature", 16, TEMP_COLOR)
+        self.Screen.blit(legend, (self.PlotRect.left, 40))
+        self.Screen.blit(widgets.renderText("Humidity", 16, HUMIDITY_COLOR),
+                         (self.PlotRect.left + legend.get_width() + 20, 40))
+
+        if self.Chart is not None:
+            self.Screen.blit(self.Chart, (0,0))
+        if self.Status:
+            status = widgets.renderText(self.Status, 20)
+            self.Screen.blit(status, status.get_rect(center=self.PlotRect.center))
+
+        analysis = self.AnalysisHandler(self.Sensor) if self.AnalysisHandler else None
+        if analysis is not None:
+            text = widgets.renderText(formatAnalysis(analysis), 16)
+            self.Screen.blit(text, text.get_rect(midbottom=(self.PlotRect.centerx, ANALYSIS_Y)))
+        return True
@@ -1,53 +1,720 @@
+import atexit
+import collections
 import json
-import math
 import os
-import pyenttec as dmx
 import pygame
 from pygame.locals import *
+import select
+import threading
 import time
 
 # local imports
+import assets
+import perf
 import widgets
 
 
 PRODUCTION = os.getenv("PRODUCTION")
 CONFIG_FILE = os.path.expanduser("~/.dmx.config")
+CHANNEL_MAP_FILE = os.path.expanduser("~/.dmx.channels")
 MANIFOLD_BG = os.path.join(widgets.IMG_DIR, "manifold.png")
 BLOWER_BG = os.path.join(widgets.IMG_DIR, "blower.png")
 
-# Channel Mapping
+# Logical channels, mapped to DMX interfaces and slots by the channel map.
+# Without ~/.dmx.channels they are the first slots of a single interface:
 # 1. Lower Damper
 # 2. Upper Damper
 # 3. Blower VFD
 # 4. Exhaust Damper
-LOWER_DAMPER = '0'
-UPPER_DAMPER = '1'
-BLOWER_VFD = '2'
-EXHAUST_DAMPER = '3'
-
-UPDATE_DELAY = 5
+LOWER_DAMPER = 0
+UPPER_DAMPER = 1
+BLOWER_VFD = 2
+EXHAUST_DAMPER = 3
+
+DEFAULT_DMX_PORT = "/dev/ttyUSB0"
+# Enttec port, when set outside production frames go to it instead of
+# FakeDMX, e.g. the pty of dmxsim.py
+DMX_PORT = os.getenv("DMX_PORT")
+DMX_UNIVERSE_SIZE = 512
+DMX_MIN_UNIVERSE_SIZE = 24
+# Seconds a frame may take to get into the serial port
+DMX_WRITE_TIMEOUT = 1.0
+DMX_STATS_FILE = os.path.expanduser(os.getenv("DMX_STATS_FILE", "~/.dmx.stats"))
+# Seconds between writes of the stats file
+DMX_STATS_INTERVAL = 10
+
+# Frames per second sent to the DMX interface
+DMX_REFRESH_RATE = float(os.getenv("DMX_REFRESH_RATE", 20))
+# Fastest a channel may move, in DMX levels per second. The VFD ramps slowly
+# so the motor never sees a current spike.
+DMX_SLEW_RATE = float(os.getenv("DMX_SLEW_RATE", 255))
+VFD_SLEW_RATE = float(os.getenv("VFD_SLEW_RATE", 50))
+# Seconds the config has to stay unchanged before it is written
+CONFIG_FLUSH_DELAY = 2.0
+
+DMX_LEVELS = 256
 
 def scale(x, in_min, in_max, out_min, out_max):
     return (x-in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
 
+# numpy is slow to import, the gauge geometry is built on first use or by
+# Control.prepare() in the background
+GEOMETRY_LOCK = threading.Lock()
+
+
+def valueTable(size, center, func):
+    # Per pixel DMX values for touches on a widget of the given size. func
+    # maps the touch angle around center in radians (0 to 2pi) to values.
+    import numpy as np
+    ys, xs = np.mgrid[0:size[1], 0:size[0]]
+    angles = np.arctan2(ys - center[1], xs - center[0]) % (2*np.pi)
+    return np.clip(np.rint(func(angles)), 0, DMX_LEVELS-1).astype(np.uint8)
+
+
+class NeedleGeometry(object):
+    """
+    Needle end points for all DMX values of a gauge whose needle turns around
+    center between angle_limit radians, and the inverse touch lookup.
+    """
+    def __init__(self, size, center, radius, angle_limit):
+        import numpy as np
+        self.Size = size
+        low, high = angle_limit
+        span = high - low
+
+        values = np.arange(DMX_LEVELS, dtype=np.float64)
+        angles = (values - 0.0) * span / (DMX_LEVELS - 1.0) + low
+        xs = (center[0] + radius*np.cos(angles)).astype(int)
+        ys = (center[1] + radius*np.sin(angles)).astype(int)
+        self.Points = list(zip(xs.tolist(), ys.tolist()))
+
+        def angleToValue(angles):
+            offset = (angles - low) % (2*np.pi)
+            # Touches outside the arc snap to the nearest end of it
+            below = offset > span + (2*np.pi - span)/2
+            return np.where(below, 0, offset * (DMX_LEVELS - 1) / span)
+        self.Values = valueTable(size, center, angleToValue)
+
+    def point(self, value):
+        return self.Points[min(DMX_LEVELS-1, max(0, int(value)))]
+
+    def valueAt(self, pos):
+        x = min(self.Size[0]-1, max(0, int(pos[0])))
+        y = min(self.Size[1]-1, max(0, int(pos[1])))
+        return int(self.Values[y, x])
+
+
+class WedgeGeometry(object):
+    """
+    Polygons for the pair of opposing wedges that show a damper position, for
+    all DMX values, and the inverse touch lookup. Polygons are in the
+    coordinates of the surface the widget is drawn on, touches are relative to
+    the widget.
+    """
+    def __init__(self, size, position, center, radius):
+        import numpy as np
+        self.Size = size
+        cx = int(position[0] + center[0])
+        cy = int(position[1] + center[1])
+
+        degrees = np.arange(360)
+        radians = degrees*np.pi/180
+        xs = cx + (radius*np.cos(radians)).astype(int)
+        ys = cy + (radius*np.sin(radians)).astype(int)
+        rim = list(zip(xs.tolist(), ys.tolist()))
+
+        # A fully closed damper (0) shows a full circle
+        values = np.arange(DMX_LEVELS, dtype=np.float64)
+        self.Angles = ((DMX_LEVELS - 1 - values) * 180 / (DMX_LEVELS - 1.0)).astype(int).tolist()
+        wedges = {}
+        for angle in set(self.Angles):
+            wedges[angle] = ([(cx, cy)] + rim[0:angle] + [(cx, cy)],
+                             [(cx, cy)] + rim[180:180+angle] + [(cx, cy)])
+        self.Wedges = [wedges[a] for a in self.Angles]
+
+        def angleToValue(angles):
+            return (DMX_LEVELS - 1) - (angles % np.pi) * (DMX_LEVELS - 1) / np.pi
+        self.Values = valueTable(size, center, angleToValue)
+
+    def polygons(self, value):
+        return self.Wedges[min(DMX_LEVELS-1, max(0, int(value)))]
+
+    def valueAt(self, pos):
+        x = min(self.Size[0]-1, max(0, int(pos[0])))
+        y = min(self.Size[1]-1, max(0, int(pos[1])))
+        return int(self.Values[y, x])
+
+
+class DMXUniverse(object):
+    """
+    The DMX channels stored in place inside a ready to send Enttec "Output
+    Only Send DMX" packet, so a frame goes to the port without being copied.
+    Writes that change a channel are marked in a dirty bitmap which
+    changes() returns and clears.
+    """
+    # Start of message, label, data length LSB/MSB, DMX start code
+    HEADER_SIZE = 5
+
+    def __init__(self, size=DMX_UNIVERSE_SIZE):
+        self.Size = size
+        length = size + 1
+        self.Packet = bytearray(self.HEADER_SIZE + size + 1)
+        self.Packet[0:4] = bytes((0x7E, 6, length & 0xFF, (length >> 8) & 0xFF))
+        self.Packet[-1] = 0xE7
+        self.Frame = memoryview(self.Packet)[self.HEADER_SIZE:self.HEADER_SIZE + size]
+        self.Dirty = bytearray(size)
+        self.DirtyCount = 0
+        self.Arrays = None
+
+    def __len__(self):
+        return self.Size
+
+    def __getitem__(self, channel):
+        return self.Frame[channel]
+
+    def __setitem__(self, channel, value):
+        if self.Frame[channel] != value:
+            self.Frame[channel] = value
+            if not self.Dirty[channel]:
+                self.Dirty[channel] = 1
+                self.DirtyCount += 1
+
+    def arrays(self):
+        # numpy views of the channels and the dirty bitmap for bulk writes
+        if self.Arrays is None:
+            import numpy as np
+            self.Arrays = (np.frombuffer(self.Packet, np.uint8, self.Size, self.HEADER_SIZE),
+                           np.frombuffer(self.Dirty, np.uint8))
+        return self.Arrays
+
+    def assign(self, levels, changed):
+        # Set every channel from levels, changed is a bool scratch array
+        import numpy as np
+        frame, dirty = self.arrays()
+        np.not_equal(levels, frame, out=changed)
+        if changed.any():
+            np.copyto(frame, levels, casting="unsafe")
+            np.bitwise_or(dirty, changed, out=dirty)
+            self.DirtyCount = int(np.count_nonzero(dirty))
+
+    def changes(self):
+        # [(channel, value)] changed since the last call
+        if not self.DirtyCount:
+            return []
+        changed = []
+        channel = self.Dirty.find(1)
+        while channel >= 0:
+            changed.append((channel, self.Frame[channel]))
+            channel = self.Dirty.find(1, channel + 1)
+        self.Dirty[:] = bytes(self.Size)
+        self.DirtyCount = 0
+        return changed
+
+
+class EnttecDMX(object):
+    """
+    Enttec DMX USB Pro output. pyenttec sets the port up, frames are written
+    straight from the universe's packet buffer since pyserial copies whatever
+    it is given into a new bytes object.
+    """
+    def __init__(self, universe, port=DEFAULT_DMX_PORT):
+        import pyenttec
+        self.Universe = universe
+        self.Connection = pyenttec.DMXConnection(port)
+        self.Fd = self.Connection.com.fileno()
+        self.Packet = memoryview(universe.Packet)
+
+    def render(self):
+        data = self.Packet
+        deadline = time.monotonic() + DMX_WRITE_TIMEOUT
+        while data:
+            try:
+                data = data[os.write(self.Fd, data):]
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([], [self.Fd], [], remaining)[1]:
+                    raise IOError("DMX write timed out")
+
+    def close(self):
+        self.Connection.close()
+
+
 class FakeDMX(object):
-    def __init__(self):
-        self.dmx_frame = {}
+    def __init__(self, universe, name=None):
+        self.Universe = universe
+        self.Name = name
+        self.Last = bytes(len(universe))
+        self.Frames = 0
 
     def render(self):
-        print("DMX_FRAME: %s"%self.dmx_frame)
-        self.dmx_frame = {}
+        self.Frames += 1
+        # Only print frames that carry changes
+        frame = self.Universe.Frame
+        if frame != self.Last:
+            changed = dict((i, frame[i]) for i in range(len(frame)) if frame[i] != self.Last[i])
+            if self.Name:
+                print("DMX_FRAME %s: %s"%(self.Name, changed))
+            else:
+                print("DMX_FRAME: %s"%changed)
+            self.Last = frame.tobytes()
         return
 
+    def close(self):
+        pass
+
+
+class RampEngine(object):
+    """
+    Moves every channel of a universe toward its target by at most its slew
+    rate per second. All channels are stepped together with preallocated
+    numpy buffers, and nothing is computed while every channel is at its
+    target. numpy is imported with the first target, on the output thread.
+    """
+    def __init__(self, universe, default_rate=DMX_SLEW_RATE, rates=None):
+        self.Universe = universe
+        self.DefaultRate = default_rate
+        self.Rates = dict(rates or {})
+        self.Moving = False
+        self.Buffers = None
+
+    def setup(self):
+        import numpy as np
+        size = len(self.Universe)
+        frame, dirty = self.Universe.arrays()
+        self.Current = frame.astype(np.float64)
+        self.Target = self.Current.copy()
+        self.Rate = np.full(size, self.DefaultRate)
+        for channel, rate in self.Rates.items():
+            self.Rate[channel] = rate
+        self.Step = np.empty(size)
+        self.Limit = np.empty(size)
+        self.Delta = np.empty(size)
+        self.Levels = np.empty(size)
+        self.Changed = np.empty(size, dtype=bool)
+        self.Buffers = np
+
+    def setTarget(self, channel, value):
+        # True if the target changed
+        if self.Buffers is None:
+            self.setup()
+        if self.Target[channel] == value:
+            return False
+        self.Target[channel] = value
+        self.Moving = True
+        return True
+
+    def tick(self, dt):
+        if not self.Moving or dt <= 0:
+            return
+        np = self.Buffers
+        np.subtract(self.Target, self.Current, out=self.Delta)
+        np.multiply(self.Rate, dt, out=self.Step)
+        np.negative(self.Step, out=self.Limit)
+        np.minimum(self.Delta, self.Step, out=self.Delta)
+        np.maximum(self.Delta, self.Limit, out=self.Delta)
+        np.add(self.Current, self.Delta, out=self.Current)
+
+        np.rint(self.Current, out=self.Levels)
+        self.Universe.assign(self.Levels, self.Changed)
+
+        np.subtract(self.Target, self.Current, out=self.Delta)
+        self.Moving = bool(self.Delta.any())
+
+
+class DMXStats(object):
+    """
+    Counters and timing histograms of the DMX output: how long a frame takes
+    to write, the frame rate actually sent, updates coalesced before they were
+    sent, frame slots missed by a late output thread and the delay between a
+    touch changing a value and the end of the frame carrying it.
+    """
+    def __init__(self):
+        self.Render = perf.RollingHistogram()
+        self.Latency = perf.RollingHistogram()
+        self.Times = collections.deque(maxlen=perf.HISTOGRAM_SIZE)
+        self.Frames = 0
+        self.Errors = 0
+        self.Coalesced = 0
+        self.Dropped = 0
+
+    def frame(self, start, end):
+        self.Frames += 1
+        self.Render.add(end - start)
+        self.Times.append(end)
+
+    def fps(self):
+        if len(self.Times) < 2:
+            return 0.0
+        span = self.Times[-1] - self.Times[0]
+        if span <= 0:
+            return 0.0
+        return (len(self.Times) - 1)/span
+
+    def snapshot(self):
+        # Times in milliseconds
+        render = self.Render.summary()
+        latency = self.Latency.summary()
+        return {
+            "time": time.time(),
+            "fps": self.fps(),
+            "frames": self.Frames,
+            "errors": self.Errors,
+            "coalesced": self.Coalesced,
+            "dropped": self.Dropped,
+            "render_ms": dict(zip(("p50", "p95", "p99"), (1000*t for t in render))),
+            "latency_ms": dict(zip(("p50", "p95", "p99"), (1000*t for t in latency))),
+        }
+
+    def logSummary(self, log, name):
+        stats = self.snapshot()
+        log.info("DMX output %s: %.1f fps, %d frames, %d errors, %d coalesced, %d dropped" % (
+            name, stats["fps"], stats["frames"], stats["errors"], stats["coalesced"], stats["dropped"]))
+        log.info("    render p50/p95/p99 %.1f/%.1f/%.1f ms, touch to frame %.1f/%.1f/%.1f ms" % (
+            tuple(stats["render_ms"][p] for p in ("p50", "p95", "p99")) +
+            tuple(stats["latency_ms"][p] for p in ("p50", "p95", "p99"))))
+
+    def write(self, path):
+        # Readers never see a partial file, durability doesn't matter here
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(tmp, path)
+
+
+class DMXOutput(object):
+    """
+    Sends the DMX universe from its own thread at a fixed rate. The UI queues
+    channel values with set() which never touches the serial port, changes
+    made between two frames are coalesced and every frame carries the most
+    recent value of every channel. Channels ramp to new values through a
+    RampEngine with the per slot slew rates. Timings are kept in a
+    DMXStats, logged every perf.SUMMARY_INTERVAL seconds and written to
+    stats_file.
+    """
+    def __init__(self, log, name, universe, connection, rate=DMX_REFRESH_RATE, rates=None, stats_file=None):
+        self.Log = log
+        self.Name = name
+        self.Universe = universe
+        self.Connection = connection
+        self.Interval = 1.0/rate
+        self.Ramp = RampEngine(universe, rates=rates)
+        self.LastFrame = None
+        self.Lock = threading.Lock()
+        self.Pending = {}
+        # Oldest touch time of the pending values
+        self.PendingSince = None
+        self.Stats = DMXStats()
+        self.StatsFile = stats_file
+        self.LastSummary = time.monotonic()
+        self.LastStats = self.LastSummary
+        self.Failing = False
+        self.Running = True
+
+        self.Thread = threading.Thread(target=self.run, daemon=True)
+        self.Thread.start()
+
+    def set(self, channel, value, since=None):
+        # Queue a target, the channel ramps to it from the next frame. since
+        # is the monotonic time of the touch that caused it.
+        with self.Lock:
+            if channel in self.Pending:
+                self.Stats.Coalesced += 1
+            self.Pending[channel] = int(value)
+            if since is not None and (self.PendingSince is None or since < self.PendingSince):
+                self.PendingSince = since
+
+    def sendFrame(self):
+        with self.Lock:
+            pending = self.Pending
+            since = self.PendingSince
+            self.Pending = {}
+            self.PendingSince = None
+
+        for k, v in pending.items():
+            if self.Ramp.setTarget(k, v):
+                self.Log.info("Settings DMX %s channel %s to %d" % (self.Name, k, v))
+
+        # Step by the real time between frames, but never by more than two
+        # frames so a stall doesn't turn into a jump
+        now = time.monotonic()
+        if self.LastFrame is not None:
+            self.Ramp.tick(min(now - self.LastFrame, 2*self.Interval))
+        self.LastFrame = now
+        for k, v in self.Universe.changes():
+            self.Log.debug("DMX %s channel %s at %d" % (self.Name, k, v))
+
+        try:
+            start = time.monotonic()
+            self.Connection.render()
+            end = time.monotonic()
+            self.Stats.frame(start, end)
+            if since is not None:
+                self.Stats.Latency.add(end - since)
+            if self.Failing:
+                self.Log.info("DMX output %s recovered"%self.Name)
+                self.Failing = False
+        except Exception as e:
+            self.Stats.Errors += 1
+            # Only log the start of an outage, not every frame
+            if not self.Failing:
+                self.Log.error("DMX output %s failed: %s"%(self.Name, str(e)))
+                self.Failing = True
+
+    def reportStats(self):
+        now = time.monotonic()
+        if now - self.LastSummary > perf.SUMMARY_INTERVAL:
+            self.LastSummary = now
+            self.Stats.logSummary(self.Log, self.Name)
+        if self.StatsFile and now - self.LastStats > DMX_STATS_INTERVAL:
+            self.LastStats = now
+            try:
+                self.Stats.write(self.StatsFile)
+            except Exception as e:
+                self.Log.error("Failed to write DMX stats %s: %s"%(self.StatsFile, e))
+                self.StatsFile = None
+
+    def run(self):
+        next_frame = time.monotonic()
+        while self.Running:
+            self.sendFrame()
+            self.reportStats()
+
+            next_frame += self.Interval
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind, don't try to catch up with a burst of frames
+                self.Stats.Dropped += int(-delay/self.Interval)
+                next_frame = time.monotonic()
+
+    def close(self):
+        self.Running = False
+        self.Thread.join()
+        # Deliver anything queued after the last frame
+        self.sendFrame()
+        self.Connection.close()
+        self.Stats.logSummary(self.Log, self.Name)
+
+
+class ConfigStore(object):
+    """
+    Write-behind persistence for the DMX config. Changes are coalesced and
+    written by a background thread once they have been stable for delay
+    seconds, and on flush()/close(). Each write goes to a temporary file that
+    is fsynced and renamed over the config, so a power cut leaves either the
+    old or the new file, never a truncated one.
+    """
+    def __init__(self, log, path, delay=CONFIG_FLUSH_DELAY):
+        self.Log = log
+        self.Path = path
+        self.Delay = delay
+        self.Lock = threading.Condition()
+        # Serializes writes so an older snapshot never lands after a newer one
+        self.WriteLock = threading.Lock()
+        self.Values = {}
+        self.Dirty = False
+        self.LastChange = 0
+        self.Writes = 0
+        self.Running = True
+
+        self.Thread = threading.Thread(target=self.writer, daemon=True)
+        self.Thread.start()
+        atexit.register(self.close)
+
+    def load(self):
+        if not os.path.isfile(self.Path):
+            return None
+        try:
+            with open(self.Path) as f:
+                return json.loads(f.read())
+        except ValueError as e:
+            self.Log.error("Ignoring corrupt DMX config %s: %s"%(self.Path, e))
+            return None
+
+    def update(self, values):
+        with self.Lock:
+            self.Values = dict(values)
+            self.Dirty = True
+            self.LastChange = time.time()
+            self.Lock.notify()
+
+    def writer(self):
+        with self.Lock:
+            while self.Running:
+                if not self.Dirty:
+                    self.Lock.wait()
+                    continue
+                remaining = self.LastChange + self.Delay - time.time()
+                if remaining > 0:
+                    self.Lock.wait(remaining)
+                    continue
+
+                self.Lock.release()
+                try:
+                    self.flush()
+                finally:
+                    self.Lock.acquire()
+
+    def flush(self):
+        with self.WriteLock:
+            with self.Lock:
+                if not self.Dirty:
+                    return
+                values = self.Values
+                self.Dirty = False
+
+            try:
+                self.write(values)
+            except Exception as e:
+                self.Log.error("Failed to write DMX config %s: %s"%(self.Path, e))
+                with self.Lock:
+                    # Try again after the next delay unless something newer came in
+                    if not self.Dirty:
+                        self.Dirty = True
+                        self.LastChange = time.time()
+
+    def write(self, values):
+        # JSON keys are strings, normalize so sorting never mixes types
+        values = dict((str(k), v) for k, v in values.items())
+        tmp = self.Path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(values,
+                               sort_keys=True,
+                               indent=4, separators=(',', ': ')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.Path)
+
+        # Make the rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(self.Path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.Writes += 1
+
+    def close(self):
+        with self.Lock:
+            self.Running = False
+            self.Lock.notify()
+        self.flush()
+
+
+def defaultChannelMap():
+    # One interface with the logical channels in its first slots
+    port = DMX_PORT
+    if PRODUCTION and not port:
+        port = DEFAULT_DMX_PORT
+    return {
+        "devices": {"dmx": {"port": port}},
+        "channels": {
+            str(LOWER_DAMPER): {"device": "dmx", "channel": 0},
+            str(UPPER_DAMPER): {"device": "dmx", "channel": 1},
+            str(BLOWER_VFD): {"device": "dmx", "channel": 2, "slew": VFD_SLEW_RATE},
+            str(EXHAUST_DAMPER): {"device": "dmx", "channel": 3},
+        }
+    }
+
+
+def isInt(value):
+    # JSON true and false are ints to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def loadChannelMap(log, path):
+    """
+    The channel map at path, or the default map if there is no such file. A
+    map names the DMX interfaces and puts each logical channel in a slot of
+    one of them:
+
+        {
+            "devices": {
+                "dryer1": {"port": "/dev/ttyUSB0"},
+                "dryer2": {"port": "/dev/ttyUSB1", "rate": 30, "size": 64}
+            },
+            "channels": {
+                "0": {"device": "dryer1", "channel": 0},
+                "2": {"device": "dryer1", "channel": 2, "slew": 50},
+                "4": {"device": "dryer2", "channel": 0}
+            }
+        }
+
+    A device without a port is a FakeDMX. Raises ValueError if the map is
+    inconsistent, running with a wrong map could drive the wrong hardware.
+    """
+    if not os.path.isfile(path):
+        return defaultChannelMap()
+
+    log.info("Loading DMX channel map from %s"%path)
+    with open(path) as f:
+        channel_map = json.loads(f.read())
+
+    if not isinstance(channel_map, dict):
+        raise ValueError("DMX channel map %s: not an object"%path)
+    for key in ("devices", "channels"):
+        if not isinstance(channel_map.get(key), dict):
+            raise ValueError("DMX channel map %s: no %s"%(path, key))
+    devices = channel_map["devices"]
+    for name, device in devices.items():
+        if not isinstance(device, dict):
+            raise ValueError("DMX device %s: %r is not a device"%(name, device))
+        if not isInt(device.get("size", DMX_UNIVERSE_SIZE)):
+            raise ValueError("DMX device %s: size %r is not a number"%(name, device["size"]))
+        if not DMX_MIN_UNIVERSE_SIZE <= device.get("size", DMX_UNIVERSE_SIZE) <= DMX_UNIVERSE_SIZE:
+            raise ValueError("DMX device %s: size must be %d to %d"%(
+                name, DMX_MIN_UNIVERSE_SIZE, DMX_UNIVERSE_SIZE))
+    slots = set()
+    for k, c in channel_map["channels"].items():
+        try:
+            int(k)
+        except ValueError:
+            raise ValueError("DMX channel %s: not a channel number"%k)
+        if not isinstance(c, dict) or not isInt(c.get("channel")):
+            raise ValueError("DMX channel %s: %r has no slot number"%(k, c))
+        device = devices.get(c.get("device"))
+        if device is None:
+            raise ValueError("DMX channel %s: unknown device %s"%(k, c.get("device")))
+        if not 0 <= c["channel"] < device.get("size", DMX_UNIVERSE_SIZE):
+            raise ValueError("DMX channel %s: no slot %s on %s"%(k, c.get("channel"), c["device"]))
+        slot = (c["device"], c["channel"])
+        if slot in slots:
+            raise ValueError("DMX channel %s: slot %s of %s is already used"%(k, c["channel"], c["device"]))
+        slots.add(slot)
+    return channel_map
+
 
 class DMXWrapper(object):
+    """
+    The DMX config and its output. Logical channels are routed through the
+    channel map to the interfaces, each of which has its own universe and
+    output thread so a slow adapter can't stall the others.
+    """
     def __init__(self, log):
         self.Log = log
-        if PRODUCTION:
-            self.Dmx = dmx.DMXConnection('/dev/ttyUSB0')
-        else:
-            self.Dmx = FakeDMX()
+        channel_map = loadChannelMap(self.Log, CHANNEL_MAP_FILE)
+        devices = channel_map["devices"]
+
+        self.Outputs = {}
+        for name, device in sorted(devices.items()):
+            universe = DMXUniverse(device.get("size", DMX_UNIVERSE_SIZE))
+            if device.get("port"):
+                connection = EnttecDMX(universe, device["port"])
+            else:
+                connection = FakeDMX(universe, name if len(devices) > 1 else None)
+            rates = dict((c["channel"], c["slew"]) for c in channel_map["channels"].values()
+                         if c["device"] == name and "slew" in c)
+            stats_file = DMX_STATS_FILE
+            if len(devices) > 1:
+                stats_file = "%s.%s"%(DMX_STATS_FILE, name)
+            self.Outputs[name] = DMXOutput(self.Log, name, universe, connection,
+                                           rate=device.get("rate", DMX_REFRESH_RATE),
+                                           rates=rates, stats_file=stats_file)
+
+        # Logical channel: (output, slot)
+        self.Channels = dict((int(k), (self.Outputs[c["device"]], c["channel"]))
+                             for k, c in channel_map["channels"].items())
 
         self.Config = {
             LOWER_DAMPER: 255,
@@ -55,45 +722,79 @@ class DMXWrapper(object):
             BLOWER_VFD: 0,
             EXHAUST_DAMPER: 0
         }
-        self.Pending = dict(self.Config)
-
-        if os.path.isfile(CONFIG_FILE):
+        # Values set since the last update(), only queued while a run is on.
+        # The whole config goes out with sendAll() when a run starts.
+        self.Pending = {}
+        self.Touched = None
+        self.Sending = False
+
+        self.Store = ConfigStore(self.Log, CONFIG_FILE)
+        config = self.Store.load()
+        if config is not None:
             self.Log.info("Loading DMX config from %s"%CONFIG_FILE)
-            with open(CONFIG_FILE) as f:
-                self.Config = json.loads(f.read())
-                self.Pending = dict(self.Config)
-                # FIXME: keys are strings
+            # JSON keys are strings
+            self.Config = dict((int(k), v) for k, v in config.items())
         else:
             self.Log.info("Creating DMX config file: %s"%CONFIG_FILE)
             # Force a write
-            self.setValue(0,0)
+            self.Store.update(self.Config)
+            self.Store.flush()
+
+        unmapped = sorted(set(self.Config) - set(self.Channels))
+        if unmapped:
+            self.Log.warning("DMX channels %s are not in the channel map and won't be sent"%unmapped)
 
         # self.update()
 
     def setValue(self, channel, value):
         self.Config[channel] = int(value)
-        self.Pending[channel] = int(value)
-
-        with open(CONFIG_FILE, "w") as f:
-            f.write(json.dumps(self.Config,
-                               sort_keys=True,
-                               indent=4, separators=(',', ': ')))
+        if self.Sending:
+            if channel in self.Pending and channel in self.Channels:
+                self.Channels[channel][0].Stats.Coalesced += 1
+            self.Pending[channel] = int(value)
+            if self.Touched is None:
+                self.Touched = time.monotonic()
+        self.Store.update(self.Config)
+
+    def sendAll(self):
+        # Send the whole config and keep sending changes, e.g. when a drying
+        # run starts
+        self.Sending = True
+        self.Pending = dict(self.Config)
+        self.Touched = None
+        self.update()
+
+    def stopSending(self):
+        # Changes only go to the config until the next sendAll()
+        self.Sending = False
+        self.Pending = {}
+        self.Touched = None
+
+    def setOutput(self, channel, value):
+        # Send a value without changing the config, unmapped channels are
+        # skipped like in update()
+        if channel not in self.Channels:
+            return
+        output, slot = self.Channels[channel]
+        output.set(slot, value)
+
+    def close(self):
+        for output in self.Outputs.values():
+            output.close()
+        self.Store.close()
 
     def getValue(self, channel):
         return self.Config.get(channel, 0)
 
     def update(self):
+        # Hand the changes to the output thread, it sends them with the next frame
         if self.Pending:
             for k, v in self.Pending.items():
-                self.Log.info("Settings DMX channel %s to %d" % (k, v))
-                self.Dmx.dmx_frame[int(k)] = v
-
-            self.Dmx.render()
+                if k in self.Channels:
+                    output, slot = self.Channels[k]
+                    output.set(slot, v, self.Touched)
             self.Pending = {}
-
-    # def tempUpdate(self, channel, value):
-    #     self.Dmx.dmx_frame[int(channel)] = int(value)
-    #     self.Dmx.render()
+            self.Touched = None
 
 
 class ManifoldControl(object):
@@ -105,10 +806,9 @@ class ManifoldControl(object):
         self.LowerChannel = lower_channel
         self.UpdateHandler = update_handler
 
-        self.Background = pygame.image.load(MANIFOLD_BG).convert_alpha()
+        self.Background = assets.image(MANIFOLD_BG)
         self.Size = self.Background.get_size()
-        self.Font = pygame.font.SysFont("avenir", 36)
-        self.Text = self.Font.render("Manifold", 1, widgets.BLACK)
+        self.Text = widgets.renderText("Manifold", 36)
         self.TextSize = self.Text.get_size()
 
 
@@ -116,6 +816,9 @@ class ManifoldControl(object):
         self.BottomLimitY = self.Size[1]-25
         self.Dragging = False
         self.SliderOffset = 0
+        # Set on every render, events can arrive before the first one
+        self.Dot = pygame.Rect(0, 0, 0, 0)
+        self.StaticLayer = self.renderStatic()
 
     def adjustDampers(self, relative_slider_pos):
         if relative_slider_pos == 50:
@@ -171,7 +874,7 @@ class ManifoldControl(object):
                 self.SliderOffset = self.Dot.y - event_pos[1]
                 # print("SLIDER OFFSET: %d"%self.SliderOffset)
                 return True
-        if event.type == MOUSEBUTTONUP:
+        if event.type == MOUSEBUTTONUP and self.Dragging:
             self.Dragging = False
             return True
         if event.type == MOUSEMOTION and self.Dragging:
@@ -181,8 +884,10 @@ class ManifoldControl(object):
             return True
         return False
 
-    def render(self, surface):
-        base_surface = pygame.surface.Surface(self.Size, pygame.SRCALPHA)
+    def renderStatic(self):
+        # Everything except the slider dot, composed once
+        base_surface = pygame.surface.Surface(self.Size).convert()
+        base_surface.fill(widgets.WHITE)
         base_surface.blit(self.Background, (0,0))
 
         base_surface.blit(self.Text, (self.Size[0]/2 - self.TextSize[0]/2, 10))
@@ -207,15 +912,17 @@ class ManifoldControl(object):
                          (self.Size[0]-30-25, self.BottomLimitY),
                          (self.Size[0]-5, self.BottomLimitY),
                          2)
+        return base_surface
+
+    def render(self, surface):
+        surface.blit(self.StaticLayer, self.Position)
 
         # Draw Position
         y_pos = self.getPhysicalSliderPos()
-        self.Dot = pygame.draw.circle(base_surface,
+        self.Dot = pygame.draw.circle(surface,
                                       widgets.BLACK,
-                                      (self.Size[0]-30, y_pos),
-                                      20)
-
-        surface.blit(base_surface, self.Position)
+                                      (int(self.Position[0]+self.Size[0]-30), int(self.Position[1]+y_pos)),
+                                      20).move(-self.Position[0], -self.Position[1])
         return
 
 
@@ -227,10 +934,9 @@ class BlowerControl(object):
         self.Channel = channel
         self.UpdateHandler = update_handler
 
-        self.Background = pygame.image.load(BLOWER_BG).convert_alpha()
+        self.Background = assets.image(BLOWER_BG)
         self.Size = self.Background.get_size()
-        self.Font = pygame.font.SysFont("avenir", 36)
-        self.Text = self.Font.render("Blower", 1, widgets.BLACK)
+        self.Text = widgets.renderText("Blower", 36)
         self.TextSize = self.Text.get_size()
 
         self.LineEnd = (self.Size[0]-180, self.Size[1]-20)
@@ -241,14 +947,24 @@ class BlowerControl(object):
         self.UpButton = widgets.UpButton((self.Size[0]-55, 60), self.handleUp)
         self.DownButton = widgets.DownButton((self.Size[0]-55, self.Size[1]-60), self.handleDown)
         self.Increment = 13
+        self.Geometry = None
+        self.GrabRadius = 35
+        self.Dragging = False
+        self.StaticLayer = self.renderStatic()
+
+    def geometry(self):
+        with GEOMETRY_LOCK:
+            if self.Geometry is None:
+                self.Geometry = NeedleGeometry(self.Size, self.LineEnd, self.ControlRadius, self.AngleLimit)
+        return self.Geometry
 
     def getControlPoint(self):
-        value = float(self.Dmx.getValue(self.Channel))
-        # scale 0-255 to degrees in radians
-        angle = scale(value, 0.0, 255.0, self.AngleLimit[0], self.AngleLimit[1])
-        x = self.LineEnd[0] + (self.ControlRadius * math.cos(angle))
-        y = self.LineEnd[1] + (self.ControlRadius * math.sin(angle))
-        return (int(x),int(y))
+        return self.geometry().point(self.Dmx.getValue(self.Channel))
+
+    def setValue(self, value):
+        if value != self.Dmx.getValue(self.Channel):
+            self.Dmx.setValue(self.Channel, value)
+            self.UpdateHandler()
 
     def handleUp(self):
         v = self.Dmx.getValue(self.Channel)
@@ -272,35 +988,52 @@ class BlowerControl(object):
                 return True
             if self.DownButton.handleClick(event_pos):
                 return True
+            # Grab the knob at the end of the needle
+            x, y = self.getControlPoint()
+            if (event_pos[0]-x)**2 + (event_pos[1]-y)**2 <= self.GrabRadius**2:
+                self.Dragging = True
+                return True
+        if event.type == MOUSEBUTTONUP and self.Dragging:
+            self.Dragging = False
+            return True
+        if event.type == MOUSEMOTION and self.Dragging:
+            self.setValue(self.geometry().valueAt(event_pos))
+            return True
         return False
 
-    def render(self, surface):
-        base_surface = pygame.surface.Surface(self.Size, pygame.SRCALPHA)
+    def renderStatic(self):
+        # Everything except the needle, composed once
+        base_surface = pygame.surface.Surface(self.Size).convert()
+        base_surface.fill(widgets.WHITE)
         base_surface.blit(self.Background, (0,0))
 
         base_surface.blit(self.Text, (self.Size[0]/2 - self.TextSize[0]/2, 10))
-        zero = self.Font.render("0", 1, widgets.BLACK)
-        hundred = self.Font.render("100", 1, widgets.BLACK)
+        zero = widgets.renderText("0", 36)
+        hundred = widgets.renderText("100", 36)
         base_surface.blit(zero, (self.Size[0]/2 - 90, self.Size[1]-zero.get_size()[1]))
         base_surface.blit(hundred, (self.Size[0]-125, 100))
 
         # draw buttons
         self.UpButton.render(base_surface)
         self.DownButton.render(base_surface)
+        return base_surface
+
+    def render(self, surface):
+        surface.blit(self.StaticLayer, self.Position)
 
         # draw line control
-        pos = self.getControlPoint()
-        pygame.draw.line(base_surface,
+        x, y = self.getControlPoint()
+        pos = (int(self.Position[0]+x), int(self.Position[1]+y))
+        line_end = (int(self.Position[0]+self.LineEnd[0]), int(self.Position[1]+self.LineEnd[1]))
+        pygame.draw.line(surface,
                          widgets.BLACK,
-                         self.LineEnd,
+                         line_end,
                          pos,
                          8)
-        pygame.draw.circle(base_surface,
+        pygame.draw.circle(surface,
                            widgets.BLACK,
                            pos,
                            25)
-
-        surface.blit(base_surface, self.Position)
         return
 
 
@@ -313,8 +1046,7 @@ class RecirculationControl(object):
         self.UpdateHandler = update_handler
 
         self.Size = (400,240)
-        self.Font = pygame.font.SysFont("avenir", 36)
-        self.Text = self.Font.render("Recirculation", 1, widgets.BLACK)
+        self.Text = widgets.renderText("Recirculation", 36)
         self.TextSize = self.Text.get_size()
 
         self.LineEnd = (self.Size[0]-180, self.Size[1]-20)
@@ -325,6 +1057,11 @@ class RecirculationControl(object):
         self.UpButton = widgets.UpButton((self.Size[0]-55, 60), self.handleUp)
         self.DownButton = widgets.DownButton((self.Size[0]-55, self.Size[1]-60), self.handleDown)
         self.Increment = 13
+        self.Center = (int(self.Size[0]/2), int(self.Size[1]/2)+20)
+        self.Radius = 75
+        self.Geometry = None
+        self.Dragging = False
+        self.StaticLayer = self.renderStatic()
 
     def handleUp(self):
         v = self.Dmx.getValue(self.Channel)
@@ -348,56 +1085,69 @@ class RecirculationControl(object):
                 return True
             if self.DownButton.handleClick(event_pos):
                 return True
+            # Grab anywhere on the dial
+            x = event_pos[0] - self.Center[0]
+            y = event_pos[1] - self.Center[1]
+            if x**2 + y**2 <= self.Radius**2:
+                self.Dragging = True
+                self.setValue(self.geometry().valueAt(event_pos))
+                return True
+        if event.type == MOUSEBUTTONUP and self.Dragging:
+            self.Dragging = False
+            return True
+        if event.type == MOUSEMOTION and self.Dragging:
+            self.setValue(self.geometry().valueAt(event_pos))
+            return True
         return False
 
-    def renderWedge(self, surface, center, radius, start_angle, stop_angle):
-        p = [(center[0], center[1])]
-        for n in range(start_angle, stop_angle):
-            x = center[0] + int(radius*math.cos(n*math.pi/180))
-            y = center[1]+int(radius*math.sin(n*math.pi/180))
-            p.append((x, y))
-        p.append((center[0], center[1]))
+    def setValue(self, value):
+        if value != self.Dmx.getValue(self.Channel):
+            self.Dmx.setValue(self.Channel, value)
+            self.UpdateHandler()
 
-        # Draw pie segment
-        if len(p) > 2:
-            pygame.draw.polygon(surface, (0, 0, 0), p)
+    def geometry(self):
+        with GEOMETRY_LOCK:
+            if self.Geometry is None:
+                self.Geometry = WedgeGeometry(self.Size, self.Position, self.Center, self.Radius)
+        return self.Geometry
 
-    def render(self, surface):
-        base_surface = pygame.surface.Surface(self.Size)
+    def renderStatic(self):
+        # Everything except the wedges, composed once
+        base_surface = pygame.surface.Surface(self.Size).convert()
         pygame.draw.rect(base_surface, widgets.WHITE,
                          (0, 0, self.Size[0], self.Size[1]))
 
         base_surface.blit(self.Text, (self.Size[0]/2 - self.TextSize[0]/2, 10))
-
-        center = (int(self.Size[0]/2), int(self.Size[1]/2)+20)
-        radius = 75
-        pygame.draw.circle(base_surface, widgets.BLACK, center, radius, 2)
-
-        v = self.Dmx.getValue(self.Channel)
-        angle = int(scale(255-v, 0, 255, 0, 180))
+        pygame.draw.circle(base_surface, widgets.BLACK, self.Center, self.Radius, 2)
 
         # draw buttons
         self.UpButton.render(base_surface)
         self.DownButton.render(base_surface)
+        return base_surface
 
-        # draw line control
-        self.renderWedge(base_surface, center, radius, 0, angle)
-        self.renderWedge(base_surface, center, radius, 180, 180+angle)
+    def render(self, surface):
+        surface.blit(self.StaticLayer, self.Position)
 
-        surface.blit(base_surface, self.Position)
+        # Draw pie segments
+        for wedge in self.geometry().polygons(self.Dmx.getValue(self.Channel)):
+            if len(wedge) > 2:
+                pygame.draw.polygon(surface, widgets.BLACK, wedge)
         return
 
 
 class Control(object):
-    def __init__(self, log, screen, return_handler):
+    def __init__(self, log, screen, return_handler, profiler=None):
         self.Log = log
         self.Screen = screen
+        self.Profiler = profiler
         self.Size = self.Screen.get_size()
         self.ReturnHandler = return_handler
 
         self.Dmx = DMXWrapper(self.Log)
-        self.LastUpdate = time.time()
         self.Running = False
+        # Settings only change in response to touches, so the panel is
+        # redrawn after events rather than every frame
+        self.Dirty = True
 
         self.handleStop()
 
@@ -406,26 +1156,32 @@ class Control(object):
         self.BlowerControl = BlowerControl((0, self.Size[1]/2+1), self.Log, self.Dmx, BLOWER_VFD, self.updateDmx)
         self.RecirculationControl = RecirculationControl((self.Size[0]/2+1, self.Size[1]/2+1), self.Log, self.Dmx, EXHAUST_DAMPER, self.updateDmx)
 
+        self.Background = pygame.surface.Surface(self.Size).convert()
+        pygame.draw.rect(self.Background, widgets.WHITE, (0,0,self.Size[0],self.Size[1]))
+        self.ReturnButton.render(self.Background)
+
+    def prepare(self):
+        # Build the gauge geometry ahead of the first visit to the settings
+        self.BlowerControl.geometry()
+        self.RecirculationControl.geometry()
+
     def handleStart(self):
         self.Running = True
         self.Log.info("Starting Controls")
-        # HACK/FIXME
-        self.Dmx.Pending = dict(self.Dmx.Config)
-        self.Dmx.update()
-        self.LastUpdate = time.time()
+        self.Dmx.sendAll()
 
     def handleStop(self):
         self.Running = False
         self.Log.info("Stopping Controls")
-        # HACK/FIXME
-        self.Dmx.Dmx.dmx_frame[int(BLOWER_VFD)] = 0
-        self.Dmx.Dmx.render()
+        self.Dmx.stopSending()
+        self.Dmx.setOutput(BLOWER_VFD, 0)
 
     def updateDmx(self):
-        now = time.time()
-        if self.Running and now - self.LastUpdate > UPDATE_DELAY:
+        if self.Running:
             self.Dmx.update()
-            self.LastUpdate = now
+
+    def shutdown(self):
+        self.Dmx.close()
 
     def handleReturn(self):
         # flush any pending dmx updates
@@ -433,7 +1189,11 @@ class Control(object):
             self.Dmx.update()
         self.ReturnHandler()
 
+    def invalidate(self):
+        self.Dirty = True
+
     def handleEvent(self, event):
+        self.Dirty = True
         if self.ManifoldControl.handleEvent(event):
             return True
         if self.BlowerControl.handleEvent(event):
@@ -446,11 +1206,16 @@ class Control(object):
         return True
 
     def render(self):
-        surface = pygame.surface.Surface(self.Size)
-        pygame.draw.rect(surface, widgets.WHITE, (0,0,self.Size[0],self.Size[1]))
-        self.ReturnButton.render(surface)
-        self.ManifoldControl.render(surface)
-        self.BlowerControl.render(surface)
-        self.RecirculationControl.render(surface)
-
-        self.Screen.blit(surface, (0,0))
+        if not self.Dirty:
+            return False
+        self.Dirty = False
+
+        self.Screen.blit(self.Background, (0,0))
+        for c in (self.ManifoldControl, self.BlowerControl, self.RecirculationControl):
+            if self.Profiler is None:
+                c.render(self.Screen)
+            else:
+                t = self.Profiler.begin()
+                c.render(self.Screen)
+                self.Profiler.end(c.__class__.__name__, t)
+        return True
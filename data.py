@@ -1,12 +1,162 @@
 import datetime
 import json
 import os
+import random
+import socket
 import time
 
-from influxdb import InfluxDBClient
+# Local imports
+import spool
 
 INFLUXDB_CONFIG_FILE = os.path.expanduser("~/.influxdb.config")
+# Client errors that are worth retrying a write for, the rest mean the data
+# is bad: unauthorized, forbidden, not found (database not created yet) and
+# too many requests
+RETRY_CODES = (401, 403, 404, 429)
 
+# Seconds, a dead uplink fails fast on connect but a slow query gets time
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# Connections kept open to InfluxDB, shared by queries and writes
+POOL_SIZE = 2
+# TCP keepalive probes stop the farm router from dropping the idle
+# connection between refreshes, so a refresh doesn't pay for a new TLS
+# handshake. Idle seconds, seconds between probes, probes.
+KEEPALIVE = (30, 10, 3)
+
+# Failed refreshes in a row before the data source is left alone, and the
+# first and longest backoff in seconds
+BREAKER_THRESHOLD = 3
+BREAKER_BACKOFF = 30
+BREAKER_MAX_BACKOFF = 15*60
+# Fraction of a backoff added or removed at random, so several dryers don't
+# retry in lockstep
+BREAKER_JITTER = 0.2
+
+# Seconds back a sensor's readings count as current
+CURRENT_WINDOW = 5*60
+# Series per chunk of a streamed query response
+CHUNK_SIZE = 100
+# Most points per measurement queryHistory() asks the server for
+HISTORY_POINTS = 2000
+# Readings fetched together by queryCurrent(), name: measurement
+CURRENT_MEASUREMENTS = [
+    ("temperature", "temperature_fahrenheit"),
+    ("humidity", "humidity_percentage"),
+]
+
+
+class Reading(object):
+    """
+    Latest reading of a sensor: epoch ms, value and the time.time() it was
+    first seen.
+    """
+    __slots__ = ("Time", "Value", "Seen")
+
+    def __init__(self, t, value, seen):
+        self.Time = t
+        self.Value = value
+        self.Seen = seen
+
+
+def iterSeries(lines):
+    """
+    Decodes a chunked InfluxDB query response one line at a time. Yields
+    (statement id, tags, columns, values) for every series, values are the
+    raw rows without building a dict per point.
+    """
+    for line in lines:
+        if not line:
+            continue
+        chunk = json.loads(line)
+        if "error" in chunk:
+            raise IOError(chunk["error"])
+        for result in chunk.get("results", ()):
+            if "error" in result:
+                raise IOError(result["error"])
+            for series in result.get("series", ()):
+                yield result.get("statement_id", 0), series.get("tags", {}), series["columns"], series["values"]
+
+
+def keepaliveOptions(idle, interval, count):
+    # Socket options for the connection pool, on top of urllib3's defaults
+    from urllib3.connection import HTTPConnection
+    options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Not every platform can tune the probes
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)]
+    return options
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a service that keeps failing. After threshold failures in a
+    row the circuit opens and call() raises CircuitOpenError without calling
+    until the backoff has passed. Then one probe call is let through
+    (half-open), if it fails the backoff doubles up to max_backoff, if it
+    succeeds the circuit closes again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, log, name, threshold=BREAKER_THRESHOLD, backoff=BREAKER_BACKOFF,
+                 max_backoff=BREAKER_MAX_BACKOFF, jitter=BREAKER_JITTER):
+        self.Log = log
+        self.Name = name
+        self.Threshold = threshold
+        self.Backoff = backoff
+        self.MaxBackoff = max_backoff
+        self.Jitter = jitter
+        self.State = self.CLOSED
+        self.Failures = 0
+        self.Opens = 0
+        self.RetryAt = 0
+
+    def delay(self):
+        # Seconds until a call will be let through
+        if self.State != self.OPEN:
+            return 0
+        return max(0, self.RetryAt - time.time())
+
+    def call(self, func, *args, **kwargs):
+        if self.State == self.OPEN:
+            if self.delay() > 0:
+                raise CircuitOpenError("%s circuit open for another %.0f s"%(self.Name, self.delay()))
+            self.State = self.HALF_OPEN
+            self.Log.info("%s circuit half-open, probing"%self.Name)
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+        self.success()
+        return result
+
+    def success(self):
+        if self.State != self.CLOSED:
+            self.Log.info("%s circuit closed"%self.Name)
+        self.State = self.CLOSED
+        self.Failures = 0
+        self.Opens = 0
+
+    def failure(self):
+        self.Failures += 1
+        if self.State == self.HALF_OPEN or self.Failures >= self.Threshold:
+            backoff = min(self.MaxBackoff, self.Backoff * 2**self.Opens)
+            backoff *= 1 + random.uniform(-self.Jitter, self.Jitter)
+            self.Opens += 1
+            self.State = self.OPEN
+            self.RetryAt = time.time() + backoff
+            self.Log.warning("%s circuit open after %d failures, retrying in %.0f s"%(
+                self.Name, self.Failures, backoff))
 
 
 class DataSource(object):
@@ -16,67 +166,207 @@ class DataSource(object):
         with open(INFLUXDB_CONFIG_FILE) as f:
             config = json.load(f)
 
+        # Imported here, it is slow to load and only needed on the data thread
+        from influxdb import InfluxDBClient
+        self.Database = config['database']
         self.Influx = InfluxDBClient(config['host'],
                                      config['port'],
                                      config['login'],
                                      config['password'],
                                      config['database'],
                                      ssl=True,
-                                     timeout=60)
+                                     timeout=(config.get('connect_timeout', CONNECT_TIMEOUT),
+                                              config.get('read_timeout', READ_TIMEOUT)),
+                                     pool_size=config.get('pool_size', POOL_SIZE),
+                                     socket_options=keepaliveOptions(*KEEPALIVE))
+        # Only ask for readings newer than the ones already seen
+        self.Incremental = config.get('incremental', True)
+        # {measurement: {sensor: Reading}}
+        self.LastSeen = {}
         self.Points = []
         self.LastSent = datetime.datetime.now()
         self.Interval = 60
-        self.MaxPoints = 250
+        # Points are written through an on-disk spool so an outage of the
+        # uplink doesn't lose them
+        self.Spool = spool.Spool(self.Log, config.get('spool_dir', spool.SPOOL_DIR))
+        self.Writer = spool.SpoolWriter(self.Log, self.Spool, self.sendLines)
 
     def getTime(self):
         now = datetime.datetime.utcnow()
         return now.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-    def queryCurrentTemps(self):
-        r = self.query('''SELECT "sensor","value" FROM "temperature_fahrenheit" WHERE ("location" = 'dryer') AND time >= now() - 5m GROUP BY "sensor" ORDER by time DESC''')
+    def currentStatement(self, measurement):
+        return '''SELECT "sensor","value" FROM "%s" WHERE ("location" = 'dryer') AND time >= now() - %ds GROUP BY "sensor" ORDER by time DESC'''%(measurement, CURRENT_WINDOW)
+
+    def incrementalStatement(self, measurement):
+        # InfluxQL can't OR time ranges, so the bound is the oldest last seen
+        # reading and fetchLatest() skips the repeats
+        since = ""
+        seen = self.LastSeen.get(measurement)
+        if seen:
+            since = " AND time > %dms"%min(r.Time for r in seen.values())
+        return '''SELECT LAST("value") AS "value" FROM "%s" WHERE ("location" = 'dryer') AND time >= now() - %ds%s GROUP BY "sensor"'''%(measurement, CURRENT_WINDOW, since)
+
+    def queryStream(self, q):
+        # Streams the response of q with epoch ms times through iterSeries()
+        response = self.Influx.request("query",
+                                       params={"q": q, "db": self.Database, "epoch": "ms",
+                                               "chunked": "true", "chunk_size": CHUNK_SIZE},
+                                       stream=True,
+                                       headers={"Accept": "application/json"})
+        try:
+            for series in iterSeries(response.iter_lines()):
+                yield series
+        finally:
+            response.close()
+
+    def fetchLatest(self, measurements):
+        # Fold the readings newer than the last seen ones into LastSeen
+        q = ";".join(self.incrementalStatement(m) for name, m in measurements)
+        now = time.time()
+        for statement, tags, columns, values in self.queryStream(q):
+            seen = self.LastSeen.setdefault(measurements[statement][1], {})
+            sensor = tags['sensor']
+            t = columns.index('time')
+            v = columns.index('value')
+            for row in values:
+                reading = seen.get(sensor)
+                if reading is None:
+                    seen[sensor] = Reading(row[t], int(row[v]), now)
+                elif row[t] > reading.Time:
+                    reading.Time = row[t]
+                    reading.Value = int(row[v])
+                    reading.Seen = now
+
+    def latest(self, measurement):
+        # {sensor: value}, sensors that stopped reporting drop out like with
+        # the full query
+        seen = self.LastSeen.get(measurement, {})
+        now = time.time()
+        for sensor in [k for k, r in seen.items() if now - r.Seen > CURRENT_WINDOW]:
+            del seen[sensor]
+        return dict((k, r.Value) for k, r in seen.items())
+
+    def parseCurrent(self, r):
+        # {sensor: latest value} from a ResultSet grouped by sensor
         points = [p for p in r]
         result = {}
-        self.Log.debug("Temperature data: %s"%points)
         for sensor_data in points:
             if len(sensor_data) > 0:
                 result[sensor_data[0]['sensor']] = int(sensor_data[0]['value'])
-        # self.Log.debug("temp result: %s"%result)
         return result
 
+    def queryCurrent(self, measurements=CURRENT_MEASUREMENTS):
+        """
+        The latest value of every sensor for all measurements, fetched with a
+        single multi-statement query. Returns {name: {sensor: value}}. In
+        incremental mode only readings newer than the last seen ones are
+        fetched, reduced to one per sensor by the server, and the response is
+        decoded as it streams in.
+        """
+        if self.Incremental:
+            for x in range(3):
+                try:
+                    self.fetchLatest(measurements)
+                    break
+                except Exception as e:
+                    self.Log.error("Query failed: %s"%str(e))
+                time.sleep(0.2)
+            else:
+                raise IOError("No response to the current readings query")
+            snapshot = dict((name, self.latest(m)) for name, m in measurements)
+            self.Log.debug("Current data: %s"%snapshot)
+            return snapshot
+
+        r = self.query(";".join(self.currentStatement(m) for name, m in measurements))
+        if r is None:
+            raise IOError("No response to the current readings query")
+        # The client only returns a list for more than one statement
+        if not isinstance(r, list):
+            r = [r]
+        snapshot = {}
+        for (name, measurement), result in zip(measurements, r):
+            snapshot[name] = self.parseCurrent(result)
+        self.Log.debug("Current data: %s"%snapshot)
+        return snapshot
+
+    def historyStatement(self, measurement, sensor, hours, interval):
+        return '''SELECT MEAN("value") AS "value" FROM "%s" WHERE ("location" = 'dryer') AND ("sensor" = '%s') AND time >= now() - %dh GROUP BY time(%ds) fill(none)'''%(
+            measurement, sensor.replace("'", "\\'"), hours, interval)
+
+    def queryHistory(self, sensor, hours, measurements=CURRENT_MEASUREMENTS, points=HISTORY_POINTS):
+        """
+        The last hours of sensor averaged by the server into at most points
+        buckets per measurement, in one query. Returns {name: (times, values)}
+        lists with times in epoch seconds.
+        """
+        interval = max(1, int(hours*3600/points))
+        q = ";".join(self.historyStatement(m, sensor, hours, interval) for name, m in measurements)
+        history = dict((name, ([], [])) for name, m in measurements)
+        for statement, tags, columns, values in self.queryStream(q):
+            times, series = history[measurements[statement][0]]
+            t = columns.index('time')
+            v = columns.index('value')
+            for row in values:
+                times.append(row[t]/1000.0)
+                series.append(row[v])
+        return history
+
+    def readingTimes(self, measurements=CURRENT_MEASUREMENTS):
+        # {name: {sensor: epoch seconds}} of the readings in the last
+        # incremental snapshot, empty for the full query
+        times = {}
+        for name, measurement in measurements:
+            seen = self.LastSeen.get(measurement, {})
+            times[name] = dict((k, r.Time/1000.0) for k, r in seen.items())
+        return times
+
+    def queryCurrentTemps(self):
+        return self.queryCurrent([("temperature", "temperature_fahrenheit")])["temperature"]
+
     def queryCurrentHumidty(self):
-        r = self.query('''SELECT "sensor","value" FROM "humidity_percentage" WHERE ("location" = 'dryer') AND time >= now() - 5m GROUP BY "sensor" ORDER by time DESC''')
-        points = [p for p in r]
-        self.Log.debug("Humidity data: %s"%points)
-        result = {}
-        for sensor_data in points:
-            if len(sensor_data) > 0:
-                result[sensor_data[0]['sensor']] = int(sensor_data[0]['value'])
-        # self.Log.debug("humidity result: %s"%result)
-        return result
+        return self.queryCurrent([("humidity", "humidity_percentage")])["humidity"]
 
     def writePoints(self):
-        ret = None
-
-        # drop old points if there are too many
-        if len(self.Points) > self.MaxPoints:
-            self.Points = self.Points[self.MaxPoints:]
+        """
+        Moves Points to the spool, the spool writer sends them in the
+        background. Points without a time are stamped now, they may be sent
+        much later.
+        """
+        from influxdb.line_protocol import make_lines
+        if not self.Points:
+            return True
 
-        for x in range(10):
-            try:
-                ret = self.Influx.write_points(self.Points)
-            except Exception as e:
-                self.Log.error("Influxdb point failure: %s"%(e))
-                ret = 0
-            if ret:
-                self.Log.info("%s - Sent %d points to Influx"%(datetime.datetime.now(), len(self.Points)))
-                self.LastSent = datetime.datetime.now()
-                self.Points = []
-                return ret
+        now = int(time.time()*1000)
+        for point in self.Points:
+            point.setdefault("time", now)
+        self.Spool.append(make_lines({"points": self.Points}, precision='ms'))
+        self.Log.debug("Spooled %d points, %d waiting"%(len(self.Points), self.Spool.depth()[0]))
+        self.LastSent = datetime.datetime.now()
+        self.Points = []
+        self.Writer.wake()
+        return True
 
-            time.sleep(0.2)
+    def sendLines(self, data):
+        # Writes gzip compressed line protocol, raises on failure and
+        # spool.RejectedError if the server refuses the data itself
+        from influxdb.exceptions import InfluxDBClientError
+        try:
+            self.Influx.request("write",
+                                method="POST",
+                                params={"db": self.Database, "precision": "ms"},
+                                data=data,
+                                expected_response_code=204,
+                                headers={"Content-Type": "application/octet-stream",
+                                         "Content-Encoding": "gzip"})
+        except InfluxDBClientError as e:
+            if e.code is not None and 400 <= e.code < 500 and e.code not in RETRY_CODES:
+                raise spool.RejectedError(str(e))
+            raise
 
-        self.Log.error("%s - Failed to send %d points to Influx: %s"%(datetime.datetime.now(), len(self.Points), ret))
-        return ret
+    def backlog(self):
+        # (points, bytes) spooled but not sent yet
+        return self.Spool.depth()
 
     # def sendMeasurement(self, measurement, sensor, value):
     #     # FIXME: update for dryer
@@ -96,7 +386,7 @@ class DataSource(object):
     #     self.Points.append(point)
 
     #     now = datetime.datetime.now()
-    #     if len(self.Points) >= self.MaxPoints or (now - self.LastSent).seconds >= self.Interval:
+    #     if (now - self.LastSent).seconds >= self.Interval:
     #         return self.writePoints()
     #     return True
 
@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+"""
+Enttec DMX USB Pro simulator.
+
+Opens a pseudo-terminal and reads Enttec framed packets from it the way the
+interface would, counting frames, bytes and framing errors. Point the GUI or
+the benchmark at the printed port:
+
+    python3 dmxsim.py --wire
+    DMX_PORT=/dev/pts/5 python3 gui.py
+
+The reader can be slowed to the DMX line rate (--wire) or any byte rate,
+stall for a while at intervals, or hang up, so back-pressure and write
+failures can be tested without hardware.
+"""
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+
+START_VAL = 0x7E
+END_VAL = 0xE7
+HEADER_SIZE = 4
+# Labels of the packets the host sends
+SET_PARAMETERS = 4
+SEND_DMX = 6
+# 250 kbaud with 11 bits per slot
+DMX_WIRE_RATE = 250000/11
+READ_SIZE = 4096
+
+
+class EnttecSimulator(object):
+    """
+    A pty that parses the Enttec DMX USB Pro framing. rate limits the bytes
+    read per second, every stall_every seconds the reader stops for stall_for
+    seconds and after hangup_after seconds the pty is closed so writes fail.
+    """
+    def __init__(self, rate=None, stall_every=0, stall_for=0, hangup_after=0):
+        self.Rate = rate
+        self.StallEvery = stall_every
+        self.StallFor = stall_for
+        self.HangupAfter = hangup_after
+
+        self.Master, self.Slave = pty.openpty()
+        tty.setraw(self.Slave)
+        self.Port = os.ttyname(self.Slave)
+
+        self.Lock = threading.Lock()
+        self.Buffer = bytearray()
+        self.Universe = b""
+        self.Bytes = 0
+        self.Frames = 0
+        self.Parameters = 0
+        self.Other = 0
+        self.Errors = 0
+        self.Stalls = 0
+        self.Started = time.monotonic()
+
+        self.Running = True
+        self.Thread = threading.Thread(target=self.run, daemon=True)
+        self.Thread.start()
+
+    def parse(self):
+        buf = self.Buffer
+        while buf:
+            if buf[0] != START_VAL:
+                # Skip to the next start of message, counting the junk once
+                start = buf.find(START_VAL)
+                self.Errors += 1
+                if start < 0:
+                    del buf[:]
+                    return
+                del buf[:start]
+                continue
+
+            if len(buf) < HEADER_SIZE:
+                return
+            length = buf[2] | (buf[3] << 8)
+            end = HEADER_SIZE + length
+            if len(buf) < end + 1:
+                return
+            if buf[end] != END_VAL:
+                self.Errors += 1
+                del buf[:1]
+                continue
+
+            label = buf[1]
+            if label == SEND_DMX:
+                if length < 1 or buf[HEADER_SIZE] != 0:
+                    # Missing or non zero DMX start code
+                    self.Errors += 1
+                else:
+                    self.Frames += 1
+                    self.Universe = bytes(buf[HEADER_SIZE + 1:end])
+            elif label == SET_PARAMETERS:
+                self.Parameters += 1
+            else:
+                self.Other += 1
+            del buf[:end + 1]
+
+    def stall(self, now):
+        # Stop reading for StallFor seconds every StallEvery seconds
+        if not self.StallEvery:
+            return
+        elapsed = now - self.Started
+        if elapsed % (self.StallEvery + self.StallFor) >= self.StallEvery:
+            self.Stalls += 1
+            time.sleep(self.StallEvery + self.StallFor - elapsed % (self.StallEvery + self.StallFor))
+
+    def run(self):
+        while self.Running:
+            now = time.monotonic()
+            if self.HangupAfter and now - self.Started > self.HangupAfter:
+                self.hangup()
+                return
+            self.stall(now)
+
+            if not select.select([self.Master], [], [], 0.1)[0]:
+                continue
+            size = READ_SIZE
+            if self.Rate:
+                # Read at most 10 ms worth at a time
+                size = max(1, int(self.Rate/100))
+            try:
+                data = os.read(self.Master, size)
+            except OSError:
+                return
+            with self.Lock:
+                self.Bytes += len(data)
+                self.Buffer += data
+                self.parse()
+            if self.Rate:
+                time.sleep(len(data)/self.Rate)
+
+    def hangup(self):
+        # Writes to the port fail from now on
+        self.Running = False
+        os.close(self.Master)
+
+    def snapshot(self):
+        with self.Lock:
+            elapsed = time.monotonic() - self.Started
+            return {
+                "port": self.Port,
+                "seconds": elapsed,
+                "bytes": self.Bytes,
+                "frames": self.Frames,
+                "parameters": self.Parameters,
+                "other": self.Other,
+                "errors": self.Errors,
+                "stalls": self.Stalls,
+                "fps": self.Frames/elapsed if elapsed else 0.0,
+                "bytes_per_sec": self.Bytes/elapsed if elapsed else 0.0,
+            }
+
+    def close(self):
+        if self.Running:
+            self.Running = False
+            self.Thread.join()
+            os.close(self.Master)
+        os.close(self.Slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enttec DMX USB Pro simulator")
+    parser.add_argument("--rate", type=float, help="bytes read per second (default: unlimited)")
+    parser.add_argument("--wire", action="store_true", help="read at the DMX line rate")
+    parser.add_argument("--stall-every", type=float, default=0, help="seconds between stalls")
+    parser.add_argument("--stall-for", type=float, default=0, help="seconds each stall lasts")
+    parser.add_argument("--hangup-after", type=float, default=0, help="close the port after this many seconds")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between reports")
+    args = parser.parse_args()
+
+    sim = EnttecSimulator(rate=DMX_WIRE_RATE if args.wire else args.rate,
+                          stall_every=args.stall_every,
+                          stall_for=args.stall_for,
+                          hangup_after=args.hangup_after)
+    print("Enttec simulator on %s" % sim.Port)
+    last = sim.snapshot()
+    try:
+        while True:
+            time.sleep(args.interval)
+            stats = sim.snapshot()
+            span = stats["seconds"] - last["seconds"]
+            print("%.1f fps, %.0f bytes/s, %d frames, %d errors, %d stalls, channels %s" % (
+                (stats["frames"] - last["frames"])/span,
+                (stats["bytes"] - last["bytes"])/span,
+                stats["frames"], stats["errors"], stats["stalls"],
+                list(sim.Universe[:8])))
+            last = stats
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+
+if __name__ == "__main__":
+    main()
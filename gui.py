@@ -1,5 +1,9 @@
 #! /usr/bin/env python3
 
+import time
+# Taken before the other imports so the startup trace includes them
+STARTED = time.perf_counter()
+
 import pygame
 from pygame.locals import *
 import logging
@@ -7,13 +11,17 @@ import logging.handlers
 import os
 import subprocess
 import sys
-import time
 import threading
 
 
 # Local imports
+import analytics
+import assets
+import chart
 import control
 import data
+import history
+import perf
 import widgets
 
 PRODUCTION = os.getenv("PRODUCTION")
@@ -29,62 +37,119 @@ SCREEN_ON = os.path.join(BASE_DIR, "screen-on.sh")
 SCREEN_OFF = os.path.join(BASE_DIR, "screen-off.sh")
 
 DATA_INTERVAL = 1*60
+# Readings older than this are drawn greyed out
+STALE_AFTER = 3*DATA_INTERVAL
+# Seconds from process start to the first frame
+STARTUP_BUDGET = float(os.getenv("DRYER_STARTUP_BUDGET", perf.STARTUP_BUDGET))
+# How often the input queue is checked while waiting, same as the old 30fps
+INPUT_POLL_INTERVAL = 1.0/30
+
+# Frame profiling is always available, the overlay is toggled with the p key
+# or by tapping the top left corner of the main screen three times
+PERF = os.getenv("DRYER_PERF")
+PERF_GESTURE_RECT = (0, 0, 30, 30)
+PERF_GESTURE_TAPS = 3
+PERF_GESTURE_TIME = 2
+
+# Posted by the data thread when new sensor readings are available
+DATA_EVENT = USEREVENT + 1
+# Posted when a chart history fetch is done
+CHART_EVENT = USEREVENT + 2
 
 
 class App(object):
     def __init__(self, log):
         self.Log = log
+        self.Startup = perf.StartupTrace(self.Log, STARTED, STARTUP_BUDGET)
+        self.Startup.phase("imports")
 
-        self.DataSource = data.DataSource(self.Log)
+        # Created on the data thread, the InfluxDB client is slow to import
+        # and set up
+        self.DataSource = None
         # self.Temp = self.DataSource.queryCurrentTemps()
         # self.Humidity = self.DataSource.queryCurrentHumidty()
         self.Temp = {}
         self.Humidity = {}
+        # Recent readings of every sensor, filled by the data thread
+        self.History = history.History()
+        # Latest analytics.Analysis of the history, None until there is data
+        self.Analyzer = analytics.Analyzer(self.History)
+        self.Analysis = None
+        # time.time() of the last successful refresh
+        self.DataTime = None
+        self.Breaker = data.CircuitBreaker(self.Log, "InfluxDB")
+        # Slow history queries that time out mustn't hold up the readings,
+        # and a breaker is only used from one thread
+        self.ChartBreaker = data.CircuitBreaker(self.Log, "InfluxDB history")
         self.InSettings = False
-        self.DataThread = threading.Thread(target=self.dataDaemon, args=(DATA_INTERVAL,), daemon=True)
-        self.DataThread.start()
+        self.InChart = False
 
         self.Sleeping = False
         self.LastMovement = time.time()
 
+        self.Profiler = perf.Profiler(self.Log, enabled=bool(PERF))
+        self.PerfTaps = []
+
         if PRODUCTION:
             # Work around for bug in libsdl
             os.environ['SDL_VIDEO_WINDOW_POS'] = "{0},{1}".format(0, 0)
-            pygame.init()
+        pygame.init()
+        self.Startup.phase("pygame init")
+        # Decode images and look up fonts while the display comes up
+        assets.warm(assets.imageFiles(IMG_DIR),
+                    [(widgets.FONT_NAME, size) for size in widgets.FONT_SIZES])
+
+        if PRODUCTION:
             self.Screen = pygame.display.set_mode((0, 0), pygame.NOFRAME)
             pygame.mouse.set_visible(False)
 
             # self.Screen = pygame.display.set_mode((0, 0), FULLSCREEN)
             # pygame.mouse.set_visible(0)
         else:
-            pygame.init()
             self.Screen = pygame.display.set_mode(SCREEN_SIZE)
+        self.Startup.phase("display")
+
+        # Started after pygame is initialized so it can post DATA_EVENTs
+        self.DataThread = threading.Thread(target=self.dataDaemon, args=(DATA_INTERVAL,), daemon=True)
+        self.DataThread.start()
 
-        self.Clock = pygame.time.Clock()
+        # Static parts of the main screen are composed once into the
+        # background, it is also used to restore the areas behind widgets
+        self.Background = pygame.surface.Surface(self.Screen.get_size()).convert()
+        self.Background.fill(widgets.WHITE)
+        self.Background.blit(assets.image(BACKGROUND_IMAGE), (0,0))
+        self.Outdoor = widgets.renderText("Outdoor", 18)
+        self.Background.blit(self.Outdoor, (35,7))
+        self.MainScreen = widgets.RenderGroup(self.Background, self.Profiler)
+        self.Startup.phase("background")
 
-        self.Background = pygame.image.load(BACKGROUND_IMAGE)
         self.PowerButton = widgets.PowerButton((SCREEN_SIZE[0]-55, 5), self.handlePower)
         self.SettingsButton = widgets.SettingsButton((SCREEN_SIZE[0] - (55*2),5), self.handleSettings)
-        self.Font = pygame.font.SysFont("avenir", 18)
-        self.Outdoor = self.Font.render("Outdoor", 1, widgets.BLACK)
 
-        self.ControlPanel = control.Control(self.Log, self.Screen, self.handleSettings)
+        self.ControlPanel = control.Control(self.Log, self.Screen, self.handleSettings, self.Profiler)
+        self.ChartScreen = chart.ChartScreen(self.Log, self.Screen, self.hideChart, self.fetchChart,
+                                             self.getAnalysis)
+        self.Fetching = False
+        # Latest (sensor, hours) asked for while a fetch was running
+        self.ChartRequest = None
+        self.ChartLock = threading.Lock()
+        self.Startup.phase("control panel")
 
         #
         # Sensor Widgets
         #
         self.DisplayObjects = []
-        t1 = widgets.TempAndHumidity((521,417), self.getTempAndHumidity, ("internal1",))
-        t2 = widgets.TempAndHumidity((647,307), self.getTempAndHumidity, ("internal2",))
-        t3 = widgets.TempAndHumidity((726,212), self.getTempAndHumidity, ("internal3",))
+        t1 = widgets.TempAndHumidity((521,417), self.getTempAndHumidity, ("internal1",), self.showChart)
+        t2 = widgets.TempAndHumidity((647,307), self.getTempAndHumidity, ("internal2",), self.showChart)
+        t3 = widgets.TempAndHumidity((726,212), self.getTempAndHumidity, ("internal3",), self.showChart)
 
-        t4 = widgets.TempAndHumidity((179,117), self.getTempAndHumidity, ("duct4",))
-        t5 = widgets.TempAndHumidity((138,309), self.getTempAndHumidity, ("duct5",))
-        t6 = widgets.TempAndHumidity((303,275), self.getTempAndHumidity, ("duct6",))
+        t4 = widgets.TempAndHumidity((179,117), self.getTempAndHumidity, ("duct4",), self.showChart)
+        t5 = widgets.TempAndHumidity((138,309), self.getTempAndHumidity, ("duct5",), self.showChart)
+        t6 = widgets.TempAndHumidity((303,275), self.getTempAndHumidity, ("duct6",), self.showChart)
 
-        t7 = widgets.TempAndHumidity((288,404), self.getTempAndHumidity, ("duct7",))
-        t8 = widgets.TempAndHumidity((219,368), self.getTempAndHumidity, ("duct8",))
-        t9 = widgets.TempAndHumidity((31,30), self.getTempAndHumidity, ("outdoor9",))
+        t7 = widgets.TempAndHumidity((288,404), self.getTempAndHumidity, ("duct7",), self.showChart)
+        t8 = widgets.TempAndHumidity((219,368), self.getTempAndHumidity, ("duct8",), self.showChart)
+        t9 = widgets.TempAndHumidity((31,30), self.getTempAndHumidity, ("outdoor9",), self.showChart)
 
         self.DisplayObjects.append(t1)
         self.DisplayObjects.append(t2)
@@ -99,20 +164,59 @@ class App(object):
         self.TimerControl = widgets.TimerControl((250,5),
                                                  self.ControlPanel.handleStart,
                                                  self.ControlPanel.handleStop)
-        # Position will get updated on first render
-        self.StartStop = widgets.StartStopButton((250,5), self.TimerControl.start, self.TimerControl.stop)
+        # Position follows the right edge of the timer
+        self.StartStop = widgets.StartStopButton((250,5),
+                                                 self.TimerControl.start,
+                                                 self.TimerControl.stop,
+                                                 anchor=self.TimerControl)
+
+        self.MainScreen.add(self.PowerButton)
+        self.MainScreen.add(self.SettingsButton)
+        self.MainScreen.add(self.TimerControl)
+        self.MainScreen.add(self.StartStop)
+        for d in self.DisplayObjects:
+            self.MainScreen.add(d)
+
+        self.PerfOverlay = widgets.PerfOverlay((5, SCREEN_SIZE[1]-130), self.Profiler,
+                                               status=self.perfStatus)
+        self.ShowPerf = False
+        self.Startup.phase("widgets")
 
 
     def dataDaemon(self, interval):
+        while self.DataSource is None:
+            try:
+                self.DataSource = data.DataSource(self.Log)
+            except Exception as e:
+                self.Log.error("Data source setup failed: %s"%str(e))
+                time.sleep(interval)
+
         while True:
             try:
-                self.Temp = self.DataSource.queryCurrentTemps()
-                self.Humidity = self.DataSource.queryCurrentHumidty()
+                current = self.Breaker.call(self.DataSource.queryCurrent)
+                self.Temp = current["temperature"]
+                self.Humidity = current["humidity"]
+                self.DataTime = time.time()
+                self.History.update(current, self.DataSource.readingTimes(), self.DataTime)
+                analysis = self.Analyzer.update(self.DataTime)
+                if analysis is not None:
+                    self.Analysis = analysis
                 self.Log.debug("DataDaemon: %s, %s"%(self.Temp, self.Humidity))
-                time.sleep(interval)
+            except data.CircuitOpenError:
+                pass
             except Exception as e:
                 self.Log.error("Daemon error: %s"%str(e))
 
+            # Also after failures, the badges grey out once the readings
+            # are stale. Nothing is drawn while the screen is off, the values
+            # are picked up by the full redraw on wake up.
+            if not self.Sleeping:
+                pygame.event.post(pygame.event.Event(DATA_EVENT))
+            time.sleep(max(interval, self.Breaker.delay()))
+
+    def isStale(self):
+        return self.DataTime is not None and time.time() - self.DataTime > STALE_AFTER
+
     def getTempAndHumidity(self, sensor):
         t = str(self.Temp.get(sensor, "N/A"))
         h = str(self.Humidity.get(sensor, "N/A"))
@@ -123,7 +227,51 @@ class App(object):
 
         # self.Log.debug("App Data: %s, %s"%(self.Temp, self.Humidity))
         # self.Log.debug("Sensor data: %s, %s, %s"%(sensor, t, h))
-        return (t,h)
+        return (t, h, self.isStale())
+
+    def getAnalysis(self, sensor):
+        # Drying analytics of a sensor for the chart screen, or None
+        analysis = self.Analysis
+        if analysis is None:
+            return None
+        return analysis.get(sensor)
+
+    def showChart(self, sensor):
+        self.InChart = True
+        self.ChartScreen.show(sensor)
+
+    def hideChart(self):
+        self.InChart = False
+        self.MainScreen.invalidate()
+
+    def fetchChart(self, sensor, hours):
+        # History queries can take seconds on the farm uplink, one runs at a
+        # time and only the latest request made meanwhile follows it
+        with self.ChartLock:
+            if self.Fetching:
+                self.ChartRequest = (sensor, hours)
+                return
+            self.Fetching = True
+        threading.Thread(target=self.chartDaemon, args=(sensor, hours), daemon=True).start()
+
+    def chartDaemon(self, sensor, hours):
+        while True:
+            history, error = None, None
+            try:
+                if self.DataSource is None:
+                    raise IOError("not connected")
+                history = self.ChartBreaker.call(self.DataSource.queryHistory, sensor, hours)
+            except Exception as e:
+                self.Log.error("Chart query failed: %s"%str(e))
+                error = str(e)
+            pygame.event.post(pygame.event.Event(CHART_EVENT, sensor=sensor, hours=hours,
+                                                 history=history, error=error))
+            with self.ChartLock:
+                if self.ChartRequest is None:
+                    self.Fetching = False
+                    return
+                sensor, hours = self.ChartRequest
+                self.ChartRequest = None
 
     def handlePower(self):
         if self.Sleeping:
@@ -135,11 +283,15 @@ class App(object):
     def wakeUp(self):
         self.Log.info("Wakeup!")
         self.Sleeping = False
+        self.MainScreen.invalidate()
+        self.ControlPanel.invalidate()
+        self.ChartScreen.invalidate()
         if PRODUCTION:
             subprocess.run(SCREEN_ON, shell=True)
 
     def sleep(self):
         self.Log.info("Sleeping")
+        self.Log.debug("Text cache: %s"%widgets.TEXT_CACHE.stats())
         self.Sleeping = True
         if PRODUCTION:
             subprocess.run(SCREEN_OFF, shell=False)
@@ -147,14 +299,87 @@ class App(object):
     def handleSettings(self):
         # Toggle settings mode
         self.InSettings = not self.InSettings
+        self.MainScreen.invalidate()
+        self.ControlPanel.invalidate()
 
-    def handleEvents(self):
+    def nextDeadline(self):
+        # Time at which the screen has to change without any input, the
+        # elapsed time display or going to sleep. None means never.
+        if self.Sleeping:
+            return None
+
+        deadline = self.LastMovement + SLEEP_DELAY
+        if not self.InSettings and not self.InChart:
+            tick = self.TimerControl.nextUpdate()
+            if tick is not None:
+                deadline = min(deadline, tick)
+        return deadline
+
+    def waitForEvents(self):
+        # Without a deadline, e.g. asleep, block until input or an event from
+        # the data or chart thread arrives. With one, pygame.event.wait()
+        # with a timeout spins on a 1ms SDL_Delay internally, so sleep in the
+        # OS and check the queue at the old frame rate until the deadline.
+        deadline = self.nextDeadline()
+        if deadline is None:
+            return [pygame.event.wait()] + pygame.event.get()
+        while True:
+            events = pygame.event.get()
+            if events:
+                return events
+
+            now = time.time()
+            if now >= deadline:
+                return events
+
+            time.sleep(min(INPUT_POLL_INTERVAL, deadline - now))
+
+    def perfStatus(self):
+        # Extra lines for the perf overlay
+        if self.DataSource is None:
+            return []
+        points, size = self.DataSource.backlog()
+        return ["spool backlog %d points, %d KB"%(points, size//1024)]
+
+    def togglePerfOverlay(self):
+        self.ShowPerf = not self.ShowPerf
+        if self.ShowPerf:
+            self.MainScreen.add(self.PerfOverlay)
+            if not self.Profiler.Enabled:
+                self.Profiler.toggle()
+        else:
+            self.MainScreen.remove(self.PerfOverlay)
+            if self.Profiler.Enabled and not PERF:
+                self.Profiler.toggle()
+        self.ControlPanel.invalidate()
+        self.ChartScreen.invalidate()
+
+    def checkPerfGesture(self, pos, now):
+        if not pygame.Rect(PERF_GESTURE_RECT).collidepoint(pos):
+            self.PerfTaps = []
+            return
+        self.PerfTaps = [t for t in self.PerfTaps if now - t < PERF_GESTURE_TIME] + [now]
+        if len(self.PerfTaps) >= PERF_GESTURE_TAPS:
+            self.PerfTaps = []
+            self.togglePerfOverlay()
+
+    def dropInput(self):
+        # Discard queued input but keep the events posted by the data and
+        # chart threads, they may arrive while an event is handled
+        pygame.event.get(exclude=(DATA_EVENT, CHART_EVENT))
+
+    def handleEvents(self, events):
         now = time.time()
-        for event in pygame.event.get():
+        for event in events:
             if self.Sleeping:
+                if event.type == DATA_EVENT:
+                    continue
+                if event.type == CHART_EVENT:
+                    self.ChartScreen.setData(event.sensor, event.hours, event.history, event.error)
+                    continue
                 self.LastMovement = now
                 self.wakeUp()
-                pygame.event.clear()
+                self.dropInput()
                 return True
 
             # self.Log.debug("Event: %d,%d"%event.pos)
@@ -164,51 +389,105 @@ class App(object):
                 if event.key == pygame.K_q:
                     pygame.event.clear()
                     return False
+                if event.key == pygame.K_p:
+                    self.togglePerfOverlay()
 
             if event.type == QUIT:
                 return False
 
+            if event.type == DATA_EVENT:
+                # The badges pick up the new values when they are rendered,
+                # an open chart fetches the new history
+                if self.InChart:
+                    self.ChartScreen.refresh()
+                continue
+
+            if event.type == CHART_EVENT:
+                self.ChartScreen.setData(event.sensor, event.hours, event.history, event.error)
+                continue
+
             if self.InSettings:
                 self.ControlPanel.handleEvent(event)
+            elif self.InChart:
+                if event.type == MOUSEBUTTONDOWN:
+                    self.LastMovement = now
+                self.ChartScreen.handleEvent(event)
             else:
                 if event.type == MOUSEBUTTONDOWN:
                     self.LastMovement = now
+                    self.checkPerfGesture(event.pos, now)
                     # self.Log.debug("Event pos: %d,%d"%(event.pos))
-                    # self.Log.debug("Start Rect: %s"%(self.StartStop.Rectangle))
+                    # self.Log.debug("Start Rect: %s"%(self.StartStop.Rect))
                     self.PowerButton.handleClick(event.pos)
                     self.SettingsButton.handleClick(event.pos)
                     self.StartStop.handleClick(event.pos)
+                    for d in self.DisplayObjects:
+                        d.handleClick(event.pos)
 
-            pygame.event.clear()
+            self.dropInput()
 
         if now - self.LastMovement > SLEEP_DELAY and not self.Sleeping:
             self.sleep()
 
         return True
 
+    def shutdown(self):
+        # Make sure the latest settings are on disk
+        self.ControlPanel.shutdown()
+
     def run(self):
-        while True:
-            self.Clock.tick(30)
-            if not self.handleEvents():
-                return
+        # Get the first frame on screen before anything else
+        self.step([])
+        self.Startup.finish()
+        threading.Thread(target=self.ControlPanel.prepare, daemon=True).start()
+
+        while self.step(self.waitForEvents()):
+            pass
+
+    def step(self, events):
+        # Handle one batch of events and redraw what changed. Returns False
+        # when the app should quit.
+        start = self.Profiler.begin()
+        running = self.handleEvents(events)
+        self.Profiler.end("events", start)
+        if not running:
+            return False
 
+        if self.Sleeping:
+            return True
 
+        if self.InSettings or self.InChart:
+            t = self.Profiler.begin()
             if self.InSettings:
-                self.ControlPanel.render()
+                drawn = self.ControlPanel.render()
             else:
-                self.Screen.blit(self.Background, (0,0))
-                self.Screen.blit(self.Outdoor, (35,7))
-                self.PowerButton.render(self.Screen)
-                self.SettingsButton.render(self.Screen)
-                self.TimerControl.render(self.Screen)
-                self.StartStop.Position = (250+self.TimerControl.Rectangle.size[0], 5)
-                self.StartStop.render(self.Screen)
-
-                for d in self.DisplayObjects:
-                    d.render(self.Screen)
-
-            pygame.display.flip()
-
+                drawn = self.ChartScreen.render()
+            if drawn and self.ShowPerf:
+                self.PerfOverlay.update()
+                self.PerfOverlay.render(self.Screen)
+            self.Profiler.end("settings" if self.InSettings else "chart", t)
+
+            t = self.Profiler.begin()
+            if drawn:
+                pygame.display.flip()
+            self.Profiler.end("display", t)
+        else:
+            full = self.MainScreen.Invalid
+            t = self.Profiler.begin()
+            rects = self.MainScreen.render(self.Screen)
+            self.Profiler.end("main screen", t)
+
+            t = self.Profiler.begin()
+            drawn = bool(rects)
+            if full:
+                pygame.display.flip()
+            elif rects:
+                pygame.display.update(rects)
+            self.Profiler.end("display", t)
+
+        if drawn:
+            self.Profiler.frame(start)
+        return True
 
 
 if __name__ == "__main__":
@@ -229,6 +508,7 @@ if __name__ == "__main__":
     try:
         app = App(log)
         app.run()
+        app.shutdown()
     except Exception as e:
         log.error("Main loop failed: %s"%(e), exc_info=1)
         sys.exit(1)
@@ -0,0 +1,160 @@
+import threading
+import time
+
+
+# One day of readings at the one minute refresh
+HISTORY_CAPACITY = 24*60
+# Sensor rows allocated up front, doubled when more sensors show up
+HISTORY_ROWS = 16
+
+
+class SeriesTable(object):
+    """
+    Fixed capacity history of one measurement for all sensors, a row per
+    sensor and a column per refresh that added readings. A sensor without a
+    new reading in a refresh has nan in that column. Every column is stored
+    twice, capacity apart, so the newest n columns of all sensors are always
+    one contiguous slice and window() returns views instead of copies. A
+    view stays valid for capacity - n more appends.
+
+    numpy is slow to import, it is loaded with the first table which the
+    data thread creates.
+    """
+    def __init__(self, capacity=HISTORY_CAPACITY, rows=HISTORY_ROWS):
+        import numpy as np
+        self.Capacity = capacity
+        self.Times = np.full((rows, 2*capacity), np.nan)
+        self.Values = np.full((rows, 2*capacity), np.nan)
+        # Refresh time of every column
+        self.ColumnTimes = np.zeros(2*capacity)
+        # Newest reading of every row, nan for none
+        self.LastTimes = np.full(rows, np.nan)
+        self.LastValues = np.full(rows, np.nan)
+        # (next column, columns held), replaced as a whole so readers on
+        # other threads always see a matching pair
+        self.State = (0, 0)
+
+    def __len__(self):
+        return self.State[1]
+
+    def grow(self, rows):
+        # Make room for at least rows sensors
+        import numpy as np
+        old = len(self.LastTimes)
+        if rows <= old:
+            return
+        for name in ("Times", "Values"):
+            array = np.full((rows, 2*self.Capacity), np.nan)
+            array[:old] = getattr(self, name)
+            setattr(self, name, array)
+        for name in ("LastTimes", "LastValues"):
+            array = np.full(rows, np.nan)
+            array[:old] = getattr(self, name)
+            setattr(self, name, array)
+
+    def append(self, now, rows, times, values):
+        """
+        Adds a column at time now with the readings of the rows, arrays of
+        the same length. Readings not newer than the last one of their row
+        are skipped, so unchanged cached values aren't repeated. Returns the
+        number of readings added.
+        """
+        import numpy as np
+        # nan compares False, a row without readings takes any time
+        new = ~(times <= self.LastTimes[rows])
+        if not new.any():
+            return 0
+        rows, times, values = rows[new], times[new], values[new]
+
+        head, count = self.State
+        for column in (head, head + self.Capacity):
+            self.Times[:, column] = np.nan
+            self.Values[:, column] = np.nan
+            self.Times[rows, column] = times
+            self.Values[rows, column] = values
+            self.ColumnTimes[column] = now
+        self.LastTimes[rows] = times
+        self.LastValues[rows] = values
+        self.State = ((head + 1) % self.Capacity, min(count + 1, self.Capacity))
+        return len(rows)
+
+    def last(self):
+        # (times, values) of the newest reading of every row, nan for none
+        return self.LastTimes, self.LastValues
+
+    def window(self, n=None):
+        # Views of the times and values of the newest n columns, oldest first
+        head, count = self.State
+        if n is None or n > count:
+            n = count
+        end = head + self.Capacity
+        return self.Times[:, end - n:end], self.Values[:, end - n:end]
+
+    def since(self, t):
+        # Views of the columns that can hold readings at or after time t, the
+        # readings in them can still be older
+        head, count = self.State
+        end = head + self.Capacity
+        start = end - count + self.ColumnTimes[end - count:end].searchsorted(t)
+        return self.Times[:, start:end], self.Values[:, start:end]
+
+
+class History(object):
+    """
+    Recent readings of every sensor, a SeriesTable per measurement name (as
+    in data.CURRENT_MEASUREMENTS). A sensor has the same row in every table,
+    its index in Sensors, so measurements can be combined row by row. Filled
+    by the data thread after each refresh, read by anything that needs
+    trends without asking InfluxDB.
+    """
+    def __init__(self, capacity=HISTORY_CAPACITY):
+        self.Capacity = capacity
+        self.Lock = threading.Lock()
+        self.Tables = {}
+        self.Sensors = []
+        self.Rows = {}
+        self.Updates = 0
+
+    def update(self, snapshot, times=None, now=None):
+        """
+        Appends a data.DataSource.queryCurrent() snapshot. times has the
+        same shape with the epoch seconds of each reading, readings without
+        one are stamped now.
+        """
+        import numpy as np
+        if now is None:
+            now = time.time()
+        times = times or {}
+        added = 0
+        for name, readings in snapshot.items():
+            if not readings:
+                continue
+            sensor_times = times.get(name, {})
+            rows = np.array([self.row(s) for s in readings], dtype=np.intp)
+            t = np.array([sensor_times.get(s, now) for s in readings], dtype=float)
+            values = np.array(list(readings.values()), dtype=float)
+            added += self.table(name, create=True).append(now, rows, t, values)
+        if added:
+            self.Updates += 1
+        return added
+
+    def row(self, sensor):
+        row = self.Rows.get(sensor)
+        if row is None:
+            with self.Lock:
+                row = self.Rows[sensor] = len(self.Sensors)
+                self.Sensors.append(sensor)
+                for table in self.Tables.values():
+                    if row >= len(table.LastTimes):
+                        table.grow(2*len(table.LastTimes))
+        return row
+
+    def table(self, name, create=False):
+        table = self.Tables.get(name)
+        if table is None and create:
+            with self.Lock:
+                rows = HISTORY_ROWS
+                while rows < len(self.Sensors):
+                    rows *= 2
+                table = self.Tables.setdefault(name, SeriesTable(self.Capacity, rows))
+        return table
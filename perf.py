@@ -0,0 +1,137 @@
+import collections
+import time
+
+
+STARTUP_BUDGET = 5.0
+HISTOGRAM_SIZE = 300
+SUMMARY_INTERVAL = 5*60
+SUMMARY_LINES = 10
+
+
+class RollingHistogram(object):
+    """
+    Keeps the last size samples of a timing and reports percentiles over them.
+    """
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self.Samples = collections.deque(maxlen=size)
+        self.Count = 0
+
+    def add(self, value):
+        self.Samples.append(value)
+        self.Count += 1
+
+    def percentiles(self, *points):
+        if not self.Samples:
+            return tuple(0.0 for p in points)
+        ordered = sorted(self.Samples)
+        last = len(ordered) - 1
+        return tuple(ordered[int(round(last*p/100.0))] for p in points)
+
+    def summary(self):
+        # p50, p95, p99
+        return self.percentiles(50, 95, 99)
+
+
+class Profiler(object):
+    """
+    Frame timing hooks. Callers wrap a section with begin() and end(name, t).
+    While disabled begin() returns None and end() does nothing, so the hooks
+    can stay in the render path.
+    """
+    def __init__(self, log, enabled=False, summary_interval=SUMMARY_INTERVAL):
+        self.Log = log
+        self.Enabled = enabled
+        self.SummaryInterval = summary_interval
+        self.Timings = {}
+        self.Frames = collections.deque(maxlen=HISTOGRAM_SIZE)
+        self.LastSummary = time.time()
+
+    def toggle(self):
+        self.Enabled = not self.Enabled
+        self.Log.info("Frame profiling %s"%("enabled" if self.Enabled else "disabled"))
+        return self.Enabled
+
+    def begin(self):
+        if self.Enabled:
+            return time.perf_counter()
+        return None
+
+    def end(self, name, start):
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        timing = self.Timings.get(name)
+        if timing is None:
+            timing = RollingHistogram()
+            self.Timings[name] = timing
+        timing.add(elapsed)
+
+    def frame(self, start):
+        # Called once at the end of every rendered frame
+        if start is None:
+            return
+        self.end("frame", start)
+        now = time.time()
+        self.Frames.append(now)
+        if now - self.LastSummary > self.SummaryInterval:
+            self.LastSummary = now
+            self.logSummary()
+
+    def fps(self):
+        if len(self.Frames) < 2:
+            return 0.0
+        span = self.Frames[-1] - self.Frames[0]
+        if span <= 0:
+            return 0.0
+        return (len(self.Frames) - 1)/span
+
+    def slowest(self, count=None, exclude=("frame",)):
+        # [(name, (p50, p95, p99))] ordered by p95, in seconds
+        stats = [(name, t.summary()) for name, t in self.Timings.items() if name not in exclude]
+        stats.sort(key=lambda s: s[1][1], reverse=True)
+        if count is not None:
+            stats = stats[:count]
+        return stats
+
+    def logSummary(self):
+        frame = self.Timings.get("frame")
+        if frame is None:
+            return
+        self.Log.info("Frame timing: %.1f fps, frame p50/p95/p99 %.1f/%.1f/%.1f ms"%(
+            (self.fps(),) + tuple(1000*t for t in frame.summary())))
+        for name, stats in self.slowest(SUMMARY_LINES):
+            self.Log.info("    %s: %.1f/%.1f/%.1f ms"%((name,) + tuple(1000*t for t in stats)))
+
+
+class StartupTrace(object):
+    """
+    Per phase timings of the cold start, logged once the first frame is on
+    screen with a warning if the total is over budget seconds.
+    """
+    def __init__(self, log, start=None, budget=STARTUP_BUDGET):
+        self.Log = log
+        self.Budget = budget
+        if start is None:
+            start = time.perf_counter()
+        self.Start = start
+        self.Last = start
+        self.Phases = []
+        self.Finished = False
+
+    def phase(self, name):
+        # Ends the phase called name
+        now = time.perf_counter()
+        self.Phases.append((name, now - self.Last))
+        self.Last = now
+
+    def finish(self, name="first frame"):
+        if self.Finished:
+            return
+        self.Finished = True
+        self.phase(name)
+        total = self.Last - self.Start
+        self.Log.info("Startup took %.0f ms: %s"%(1000*total,
+            ", ".join("%s %.0f ms"%(n, 1000*t) for n, t in self.Phases)))
+        if total > self.Budget:
+            self.Log.warning("Startup over budget: %.2f s > %.2f s"%(total, self.Budget))
+        return total
@@ -0,0 +1,240 @@
+import atexit
+import gzip
+import os
+import random
+import threading
+import time
+
+
+SPOOL_DIR = os.path.expanduser("~/.dryer-spool")
+# A segment is closed and becomes one write request once it is this big or
+# at the next writer pass
+SEGMENT_BYTES = 256*1024
+# Oldest segments are dropped past this, the SD card must not fill up
+MAX_SPOOL_BYTES = 200*1024*1024
+# Seconds between writer passes
+WRITE_INTERVAL = 10
+# Seconds to wait after a failed write, doubled up to the max
+WRITE_BACKOFF = 5
+WRITE_MAX_BACKOFF = 10*60
+# Seconds between reports of a backlog that isn't cleared
+REPORT_INTERVAL = 5*60
+SEGMENT_SUFFIX = ".lp"
+# Segments the server refused are renamed to this and kept for a look
+REJECTED_SUFFIX = ".rejected"
+
+
+class RejectedError(Exception):
+    """
+    Raised by the send function of a SpoolWriter when the server refused the
+    data for good, e.g. malformed line protocol. Sending it again won't help.
+    """
+    pass
+
+
+class Spool(object):
+    """
+    Append-only on-disk queue of InfluxDB line protocol. Lines go to the open
+    segment file, rotate() closes it and the closed segments are read back
+    oldest first. Everything in the directory at startup counts as closed, so
+    a restart replays what was not sent yet.
+    """
+    def __init__(self, log, directory=SPOOL_DIR, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_SPOOL_BYTES):
+        self.Log = log
+        self.Directory = directory
+        self.SegmentBytes = segment_bytes
+        self.MaxBytes = max_bytes
+        self.Lock = threading.Lock()
+        os.makedirs(self.Directory, exist_ok=True)
+
+        # {sequence number: (lines, bytes)} of the closed segments
+        self.Closed = {}
+        # Rejected segments keep their numbers taken
+        self.Next = 0
+        for name in os.listdir(self.Directory):
+            base, suffix = os.path.splitext(name)
+            if suffix not in (SEGMENT_SUFFIX, REJECTED_SUFFIX):
+                continue
+            if not base.isdigit() or self.path(int(base)) != os.path.join(self.Directory, base + SEGMENT_SUFFIX):
+                self.Log.warning("Spool %s: ignoring %s"%(self.Directory, name))
+                continue
+            seq = int(base)
+            self.Next = max(self.Next, seq + 1)
+            if suffix == REJECTED_SUFFIX:
+                continue
+            with open(self.path(seq), "rb") as f:
+                content = f.read()
+            if content:
+                self.Closed[seq] = (content.count(b"\n"), len(content))
+            else:
+                os.remove(self.path(seq))
+        self.Current = None
+        self.CurrentLines = 0
+        self.CurrentBytes = 0
+        if self.Closed:
+            self.Log.info("Spool %s has %d points to replay"%(self.Directory, self.depth()[0]))
+
+    def path(self, seq):
+        return os.path.join(self.Directory, "%012d%s"%(seq, SEGMENT_SUFFIX))
+
+    def append(self, lines):
+        # lines is line protocol text, one point per line
+        data = lines.encode("utf-8")
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        with self.Lock:
+            if self.Current is None:
+                self.Current = open(self.path(self.Next), "ab")
+                self.Next += 1
+            self.Current.write(data)
+            # In the page cache a crash of the app doesn't lose it, fsync is
+            # left to rotate() to spare the SD card
+            self.Current.flush()
+            self.CurrentLines += data.count(b"\n")
+            self.CurrentBytes += len(data)
+            if self.CurrentBytes >= self.SegmentBytes:
+                self.rotateLocked()
+
+    def rotate(self):
+        with self.Lock:
+            self.rotateLocked()
+
+    def rotateLocked(self):
+        if self.Current is None:
+            return
+        self.Current.flush()
+        os.fsync(self.Current.fileno())
+        self.Current.close()
+        seq = int(os.path.basename(self.Current.name)[:-len(SEGMENT_SUFFIX)])
+        self.Closed[seq] = (self.CurrentLines, self.CurrentBytes)
+        self.Current = None
+        self.CurrentLines = 0
+        self.CurrentBytes = 0
+        self.trim()
+
+    def trim(self):
+        # Drop the oldest segments while over MaxBytes
+        while len(self.Closed) > 1 and sum(b for l, b in self.Closed.values()) > self.MaxBytes:
+            seq = min(self.Closed)
+            lines, size = self.Closed.pop(seq)
+            os.remove(self.path(seq))
+            self.Log.error("Spool full, dropped %d points"%lines)
+
+    def oldest(self):
+        # (sequence number, content) of the oldest closed segment or None
+        with self.Lock:
+            if not self.Closed:
+                return None
+            seq = min(self.Closed)
+        with open(self.path(seq), "rb") as f:
+            return seq, f.read()
+
+    def remove(self, seq):
+        with self.Lock:
+            # trim() may have dropped it already
+            if self.Closed.pop(seq, None) is not None:
+                os.remove(self.path(seq))
+
+    def reject(self, seq):
+        # Keep a refused segment out of the queue, renamed next to it
+        with self.Lock:
+            if self.Closed.pop(seq, None) is not None:
+                path = self.path(seq)
+                os.rename(path, path[:-len(SEGMENT_SUFFIX)] + REJECTED_SUFFIX)
+
+    def depth(self):
+        # (points, bytes) not sent yet
+        with self.Lock:
+            lines = sum(l for l, b in self.Closed.values()) + self.CurrentLines
+            size = sum(b for l, b in self.Closed.values()) + self.CurrentBytes
+        return lines, size
+
+    def close(self):
+        self.rotate()
+
+
+class SpoolWriter(object):
+    """
+    Sends a Spool from a background thread. Every interval seconds, or on
+    wake(), the open segment is closed and the closed segments are sent
+    oldest first as gzip compressed bodies through send(data). A failed send
+    stops the pass and waits an exponential backoff with jitter, so the
+    order of the points is kept and a dead uplink isn't hammered. A segment
+    send() raises RejectedError for is set aside and the pass goes on.
+    """
+    def __init__(self, log, spool, send, interval=WRITE_INTERVAL,
+                 backoff=WRITE_BACKOFF, max_backoff=WRITE_MAX_BACKOFF):
+        self.Log = log
+        self.Spool = spool
+        self.Send = send
+        self.Interval = interval
+        self.Backoff = backoff
+        self.MaxBackoff = max_backoff
+        self.Failures = 0
+        self.Sent = 0
+        self.LastReport = time.monotonic()
+        self.Wake = threading.Event()
+        self.Running = True
+
+        self.Thread = threading.Thread(target=self.run, daemon=True)
+        self.Thread.start()
+        atexit.register(self.close)
+
+    def wake(self):
+        # Send now, unless backing off
+        if not self.Failures:
+            self.Wake.set()
+
+    def sendAll(self):
+        # True once the spool is empty
+        self.Spool.rotate()
+        while True:
+            segment = self.Spool.oldest()
+            if segment is None:
+                return True
+            seq, content = segment
+            try:
+                self.Send(gzip.compress(content))
+            except RejectedError as e:
+                self.Spool.reject(seq)
+                self.Log.error("Spool write rejected, set aside %d points: %s"%(content.count(b"\n"), e))
+                continue
+            except Exception as e:
+                self.Failures += 1
+                lines, size = self.Spool.depth()
+                self.Log.error("Spool write failed, %d points (%d bytes) waiting: %s"%(lines, size, e))
+                return False
+            self.Spool.remove(seq)
+            self.Sent += content.count(b"\n")
+            if self.Failures:
+                self.Log.info("Spool write recovered, %d points waiting"%self.Spool.depth()[0])
+                self.Failures = 0
+
+    def delay(self):
+        if not self.Failures:
+            return self.Interval
+        backoff = min(self.MaxBackoff, self.Backoff * 2**(self.Failures - 1))
+        return backoff * random.uniform(0.8, 1.2)
+
+    def report(self):
+        # Log the backlog now and then while it doesn't clear
+        now = time.monotonic()
+        if now - self.LastReport < REPORT_INTERVAL:
+            return
+        self.LastReport = now
+        lines, size = self.Spool.depth()
+        if lines:
+            self.Log.info("Spool backlog %d points (%d bytes), %d sent since start"%(lines, size, self.Sent))
+
+    def run(self):
+        while self.Running:
+            self.sendAll()
+            self.report()
+            self.Wake.wait(self.delay())
+            self.Wake.clear()
+
+    def close(self):
+        # Whatever isn't sent stays on disk for the next start
+        self.Running = False
+        self.Wake.set()
+        self.Spool.close()
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import analytics
+import history
+
+
+def test_dew_point():
+    # 20 C at 60 % RH has its dew point at about 12.0 C
+    dew = analytics.dewPoint(np.array([68.0]), np.array([60.0]))
+    assert analytics.fahrenheitToCelsius(dew[0]) == pytest.approx(12.0, abs=0.05)
+    # Saturated air is at its dew point
+    dew = analytics.dewPoint(np.array([50.0, 86.0]), np.array([100.0, 100.0]))
+    assert dew == pytest.approx([50.0, 86.0])
+
+
+def test_vapor_pressure_deficit():
+    # Saturation pressure at 20 C is about 2.34 kPa
+    vpd = analytics.vaporPressureDeficit(np.array([68.0, 68.0, 68.0]), np.array([0.0, 60.0, 100.0]))
+    assert vpd == pytest.approx([2.338, 0.935, 0.0], abs=0.002)
+
+
+def test_slopes_with_masked_gaps():
+    times = np.array([
+        [0, 600, 1200, 1800],
+        [0, np.nan, 1200, 1800],
+        [0, 600, np.nan, np.nan],
+        [900, 900, 900, 0],
+    ], dtype=float)
+    values = np.array([
+        [70, 71, 72, 73],
+        [50, np.nan, 48, 47],
+        [60, 61, np.nan, np.nan],
+        [60, 61, 62, 0],
+    ], dtype=float)
+    mask = ~np.isnan(times)
+    mask[3, 3] = False
+    slope = analytics.slopes(times, values, mask)
+    # 1 per 600 s is 6 per hour
+    assert slope[0] == pytest.approx(6.0)
+    assert slope[1] == pytest.approx(-6.0)
+    # Too few samples, or all at the same time
+    assert np.isnan(slope[2])
+    assert np.isnan(slope[3])
+
+
+def test_analyzer_all_sensors():
+    h = history.History(capacity=20)
+    analyzer = analytics.Analyzer(h, window=30*60)
+    start = 1e9
+    for k in range(40):
+        now = start + 60*k
+        temperature = {"a": 70 + 0.1*k, "b": 80 - 0.05*k, "c": 60.0}
+        humidity = {"a": 60.0, "b": 50 - 0.1*k}
+        if k % 2:
+            # b misses every other refresh
+            del temperature["b"]
+        h.update({"temperature": temperature, "humidity": humidity}, now=now)
+        analysis = analyzer.update(now)
+
+    assert analysis.Sensors == ["a", "b", "c"]
+    a, b, c = [analysis.get(s) for s in analysis.Sensors]
+    assert a["temp_slope"] == pytest.approx(6.0)
+    assert a["humidity_slope"] == pytest.approx(0.0)
+    assert b["temp_slope"] == pytest.approx(-3.0)
+    assert b["humidity_slope"] == pytest.approx(-6.0)
+    assert a["dew_point"] == pytest.approx(analytics.dewPoint(np.array([73.9]), np.array([60.0]))[0])
+    # c has no humidity
+    assert np.isnan(c["dew_point"]) and np.isnan(c["vpd"]) and np.isnan(c["humidity_slope"])
+    assert c["temp_slope"] == pytest.approx(0.0)
+    assert analysis.get("d") is None
+
+    # Nothing new, no new analysis
+    assert analyzer.update(now) is None
@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import chart
+import data
+import gui
+
+
+def test_lttb_passes_short_series_through():
+    x = np.arange(10.0)
+    y = x*2
+    for threshold in (10, 20, 2):
+        rx, ry = chart.lttb(x, y, threshold)
+        assert rx is x and ry is y
+
+
+def test_lttb_keeps_endpoints_and_length():
+    x = np.arange(1000.0)
+    y = np.sin(x/50.0)
+    rx, ry = chart.lttb(x, y, 100)
+    assert len(rx) == len(ry) == 100
+    assert (rx[0], ry[0]) == (x[0], y[0])
+    assert (rx[-1], ry[-1]) == (x[-1], y[-1])
+    # Picked points are real samples in time order
+    assert np.all(np.diff(rx) > 0)
+    assert np.all(ry == y[rx.astype(int)])
+
+
+def test_lttb_keeps_spikes():
+    x = np.arange(1000.0)
+    y = np.zeros(1000)
+    y[517] = 50
+    y[733] = -50
+    rx, ry = chart.lttb(x, y, 50)
+    assert 517 in rx and 733 in rx
+
+
+def test_axis_range():
+    low, high = chart.axisRange(np.array([60.0, 80.0]))
+    assert low == pytest.approx(58) and high == pytest.approx(82)
+
+
+def test_axis_range_flat_and_empty():
+    low, high = chart.axisRange(np.array([70.0, 70.0, 70.0]))
+    assert low < 70 < high
+    assert high - low == pytest.approx(2.4)
+    low, high = chart.axisRange(np.array([]))
+    assert low < high
+
+
+class SlowSource(object):
+    # queryHistory() blocks until released, records what was asked for
+    def __init__(self):
+        self.Asked = []
+        self.Release = threading.Semaphore(0)
+
+    def queryHistory(self, sensor, hours):
+        self.Asked.append((sensor, hours))
+        self.Release.acquire()
+        return {"temperature": ([], []), "humidity": ([], [])}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # Just the chart fetching part of gui.App
+    posted = []
+    monkeypatch.setattr(gui.pygame.event, "post", posted.append)
+    a = gui.App.__new__(gui.App)
+    a.Log = logging.getLogger("test")
+    a.DataSource = SlowSource()
+    a.ChartBreaker = data.CircuitBreaker(a.Log, "test")
+    a.Fetching = False
+    a.ChartRequest = None
+    a.ChartLock = threading.Lock()
+    a.Posted = posted
+    return a
+
+
+def wait(condition):
+    for i in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+def test_chart_requests_during_a_fetch_run_after_it(app):
+    app.fetchChart("internal1", 12)
+    wait(lambda: app.DataSource.Asked)
+    # Only the latest of the requests made meanwhile follows
+    app.fetchChart("internal1", 24)
+    app.fetchChart("duct4", 48)
+    app.DataSource.Release.release()
+    wait(lambda: len(app.DataSource.Asked) == 2)
+    app.DataSource.Release.release()
+    wait(lambda: not app.Fetching)
+    assert app.DataSource.Asked == [("internal1", 12), ("duct4", 48)]
+    assert [(e.sensor, e.hours) for e in app.Posted] == [("internal1", 12), ("duct4", 48)]
+    assert all(e.error is None for e in app.Posted)
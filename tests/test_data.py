@@ -0,0 +1,150 @@
+import json
+import logging
+
+import pytest
+from influxdb.resultset import ResultSet
+
+import data
+
+
+LOG = logging.getLogger("test")
+
+
+def chunk(statement, *series):
+    # One line of a chunked response, series as (sensor, [[time, value]])
+    return json.dumps({"results": [{
+        "statement_id": statement,
+        "series": [{"name": "m", "tags": {"sensor": sensor}, "columns": ["time", "value"], "values": values}
+                   for sensor, values in series],
+    }]}).encode()
+
+
+class FakeResponse(object):
+    def __init__(self, lines):
+        self.Lines = lines
+        self.Closed = False
+
+    def iter_lines(self):
+        return iter(self.Lines)
+
+    def close(self):
+        self.Closed = True
+
+
+class FakeInflux(object):
+    """
+    Stands in for InfluxDBClient. request() answers with the next of
+    Responses, lists of lines or an exception to raise, query() with the
+    next of Results.
+    """
+    def __init__(self):
+        self.Responses = []
+        self.Results = []
+        self.Statements = []
+        self.Streams = []
+
+    def request(self, url, **kwargs):
+        self.Statements.append(kwargs["params"]["q"])
+        response = self.Responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        response = FakeResponse(response)
+        self.Streams.append(response)
+        return response
+
+    def query(self, q, **kwargs):
+        self.Statements.append(q)
+        return self.Results.pop(0)
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    config = tmp_path / "influxdb.config"
+    config.write_text(json.dumps({"host": "localhost", "port": 8086, "login": "x", "password": "x",
+                                  "database": "dryer", "spool_dir": str(tmp_path / "spool")}))
+    monkeypatch.setattr(data, "INFLUXDB_CONFIG_FILE", str(config))
+    monkeypatch.setattr(data.time, "sleep", lambda seconds: None)
+    s = data.DataSource(LOG)
+    s.Influx = FakeInflux()
+    yield s
+    s.Writer.close()
+
+
+def test_iter_series():
+    lines = [chunk(0, ("a", [[1, 70], [2, 71]])), b"", chunk(1, ("a", [[3, 40]]), ("b", [[4, 41]]))]
+    assert list(data.iterSeries(lines)) == [
+        (0, {"sensor": "a"}, ["time", "value"], [[1, 70], [2, 71]]),
+        (1, {"sensor": "a"}, ["time", "value"], [[3, 40]]),
+        (1, {"sensor": "b"}, ["time", "value"], [[4, 41]]),
+    ]
+
+
+def test_iter_series_errors():
+    with pytest.raises(IOError):
+        list(data.iterSeries([b'{"error": "timeout"}']))
+    with pytest.raises(IOError):
+        list(data.iterSeries([b'{"results": [{"statement_id": 0, "error": "bad query"}]}']))
+
+
+def test_incremental_readings(source):
+    source.Influx.Responses.append([
+        chunk(0, ("a", [[1000, 70.0]]), ("b", [[2000, 72.0]])),
+        chunk(1, ("a", [[1000, 40.0]])),
+    ])
+    assert source.queryCurrent() == {"temperature": {"a": 70, "b": 72}, "humidity": {"a": 40}}
+    reading = source.LastSeen["temperature_fahrenheit"]["a"]
+    assert (reading.Time, reading.Value) == (1000, 70)
+    seen = reading.Seen
+    assert source.Influx.Streams[0].Closed
+    assert source.readingTimes() == {"temperature": {"a": 1.0, "b": 2.0}, "humidity": {"a": 1.0}}
+
+    # Only newer readings are asked for, from the oldest last seen one, and
+    # repeats of the ones already seen are skipped
+    source.Influx.Responses.append([
+        chunk(0, ("a", [[3000, 75.0]]), ("b", [[2000, 99.0]])),
+    ])
+    assert source.queryCurrent() == {"temperature": {"a": 75, "b": 72}, "humidity": {"a": 40}}
+    statements = source.Influx.Statements[-1].split(";")
+    assert "time > 1000ms" in statements[0]
+    assert "time > 1000ms" in statements[1]
+    assert source.LastSeen["temperature_fahrenheit"]["a"].Time == 3000
+    assert source.LastSeen["temperature_fahrenheit"]["a"].Seen >= seen
+    assert source.LastSeen["temperature_fahrenheit"]["b"].Value == 72
+
+
+def test_incremental_drops_silent_sensors(source):
+    source.Influx.Responses.append([chunk(0, ("a", [[1000, 70.0]]))])
+    source.queryCurrent()
+    source.LastSeen["temperature_fahrenheit"]["a"].Seen -= data.CURRENT_WINDOW + 1
+    source.Influx.Responses.append([])
+    assert source.queryCurrent() == {"temperature": {}, "humidity": {}}
+
+
+def test_incremental_retries(source):
+    source.Influx.Responses.extend([IOError("reset"), IOError("reset"), [chunk(1, ("a", [[1000, 40.0]]))]])
+    assert source.queryCurrent() == {"temperature": {}, "humidity": {"a": 40}}
+    assert len(source.Influx.Statements) == 3
+
+    source.Influx.Responses.extend([IOError("reset")]*3)
+    with pytest.raises(IOError):
+        source.queryCurrent()
+
+
+def test_full_query(source):
+    source.Incremental = False
+    def result(statement, sensor, value):
+        return ResultSet({"statement_id": statement, "series": [{
+            "name": "m", "tags": {"sensor": sensor}, "columns": ["time", "sensor", "value"],
+            "values": [["2026-10-16T00:01:00Z", sensor, value], ["2026-10-16T00:00:00Z", sensor, value - 1]],
+        }]})
+    source.Influx.Results.append([result(0, "a", 70.0), result(1, "a", 40.0)])
+    assert source.queryCurrent() == {"temperature": {"a": 70}, "humidity": {"a": 40}}
+    assert "GROUP BY \"sensor\" ORDER by time DESC" in source.Influx.Statements[0]
+
+    # A single statement comes back as a ResultSet, not a list
+    source.Influx.Results.append(result(0, "b", 71.0))
+    assert source.queryCurrentTemps() == {"b": 71}
+
+    source.Influx.Results.append(None)
+    with pytest.raises(IOError):
+        source.queryCurrent()
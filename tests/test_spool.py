@@ -0,0 +1,146 @@
+import gzip
+import logging
+import os
+
+import pytest
+
+import spool
+
+
+LOG = logging.getLogger("test")
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    # SpoolWriter without its thread, the tests drive sendAll() themselves
+    monkeypatch.setattr(spool.SpoolWriter, "run", lambda self: None)
+    def make(s, send):
+        return spool.SpoolWriter(LOG, s, send, backoff=1, max_backoff=4)
+    return make
+
+
+def segments(directory, suffix=spool.SEGMENT_SUFFIX):
+    return sorted(n for n in os.listdir(directory) if n.endswith(suffix))
+
+
+def test_append_and_rotate(tmp_path):
+    s = spool.Spool(LOG, str(tmp_path))
+    s.append("m v=1 1")
+    s.append("m v=2 2\nm v=3 3\n")
+    assert s.depth() == (3, 24)
+    # The open segment isn't handed out before it is rotated
+    assert s.oldest() is None
+    s.rotate()
+    seq, content = s.oldest()
+    assert content == b"m v=1 1\nm v=2 2\nm v=3 3\n"
+    s.remove(seq)
+    assert s.depth() == (0, 0)
+    assert segments(str(tmp_path)) == []
+
+
+def test_rotates_at_segment_size(tmp_path):
+    s = spool.Spool(LOG, str(tmp_path), segment_bytes=16)
+    for i in range(4):
+        s.append("m v=%d %d"%(i, i))
+    # 8 byte lines, two to a segment
+    assert s.Closed == {0: (2, 16), 1: (2, 16)}
+    assert s.Current is None
+
+
+def test_trim_drops_oldest(tmp_path):
+    s = spool.Spool(LOG, str(tmp_path), segment_bytes=8, max_bytes=24)
+    for i in range(6):
+        s.append("m v=%d %d"%(i, i))
+    assert s.depth() == (3, 24)
+    seq, content = s.oldest()
+    assert content == b"m v=3 3\n"
+
+
+def test_restart_replays_in_order(tmp_path):
+    s = spool.Spool(LOG, str(tmp_path), segment_bytes=8)
+    for i in range(3):
+        s.append("m v=%d %d"%(i, i))
+    s.close()
+
+    s = spool.Spool(LOG, str(tmp_path))
+    assert s.depth() == (3, 24)
+    assert s.oldest()[1] == b"m v=0 0\n"
+    s.append("m v=3 3")
+    s.rotate()
+    assert max(s.Closed) == 3
+
+
+def test_stray_files_are_ignored(tmp_path):
+    directory = str(tmp_path)
+    for name in ("junk.lp", "7.lp", "notes.txt"):
+        with open(os.path.join(directory, name), "w") as f:
+            f.write("x\n")
+    with open(os.path.join(directory, "000000000004.rejected"), "w") as f:
+        f.write("bad\n")
+    with open(os.path.join(directory, "000000000002.lp"), "w") as f:
+        f.write("m v=1 1\n")
+    open(os.path.join(directory, "000000000003.lp"), "w").close()
+
+    s = spool.Spool(LOG, directory)
+    assert s.depth() == (1, 8)
+    # Empty segments are removed, rejected ones keep their number taken
+    assert not os.path.exists(os.path.join(directory, "000000000003.lp"))
+    assert s.Next == 5
+    assert os.path.exists(os.path.join(directory, "junk.lp"))
+
+
+def test_writer_sends_oldest_first(tmp_path, writer):
+    s = spool.Spool(LOG, str(tmp_path), segment_bytes=8)
+    sent = []
+    w = writer(s, lambda data: sent.append(gzip.decompress(data)))
+    for i in range(3):
+        s.append("m v=%d %d"%(i, i))
+    s.append("m v=3")
+    assert w.sendAll()
+    assert sent == [b"m v=0 0\n", b"m v=1 1\n", b"m v=2 2\n", b"m v=3\n"]
+    assert w.Sent == 4
+    assert s.depth() == (0, 0)
+
+
+def test_writer_stops_on_failure_and_backs_off(tmp_path, writer):
+    s = spool.Spool(LOG, str(tmp_path), segment_bytes=8)
+    sent = []
+    def send(data):
+        if not sent:
+            sent.append(None)
+            raise IOError("down")
+        sent.append(gzip.decompress(data))
+    w = writer(s, send)
+    s.append("m v=0 0")
+    s.append("m v=1 1")
+    assert not w.sendAll()
+    assert w.Failures == 1
+    assert s.depth() == (2, 16)
+    # Backing off, wake() doesn't cut the wait short
+    w.wake()
+    assert not w.Wake.is_set()
+    assert 0.8 <= w.delay() <= 1.2
+
+    assert w.sendAll()
+    assert sent[1:] == [b"m v=0 0\n", b"m v=1 1\n"]
+    assert w.Failures == 0
+    assert w.delay() == w.Interval
+
+
+def test_writer_sets_aside_rejected_segments(tmp_path, writer):
+    s = spool.Spool(LOG, str(tmp_path), segment_bytes=8)
+    sent = []
+    def send(data):
+        data = gzip.decompress(data)
+        if data.startswith(b"bad"):
+            raise spool.RejectedError("400: unable to parse")
+        sent.append(data)
+    w = writer(s, send)
+    s.append("m v=0 0")
+    s.append("bad line")
+    s.append("m v=2 2")
+    assert w.sendAll()
+    assert sent == [b"m v=0 0\n", b"m v=2 2\n"]
+    assert w.Failures == 0
+    assert segments(str(tmp_path), spool.REJECTED_SUFFIX) == ["000000000001.rejected"]
+    assert segments(str(tmp_path)) == []
@@ -1,8 +1,12 @@
+import collections
 import pygame
 from pygame.locals import *
 import os
 import time
 
+# Local imports
+import assets
+
 IMG_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "img")
 POWER_BTN = os.path.join(IMG_DIR, "power-btn.png")
 RETURN_BTN = os.path.join(IMG_DIR, "return.png")
@@ -16,14 +20,169 @@ WHITE = (255, 255, 255)
 GREY = (200, 200, 200)
 BLACK = (0, 0, 0)
 
+FONT_NAME = "avenir"
+# Sizes used by the widgets, resolved at startup
+FONT_SIZES = (16, 18, 20, 36, 48)
+TEXT_CACHE_SIZE = 256
+
+
+class TextCache(object):
+    """
+    Process wide cache of rendered text surfaces keyed by (font, size, text,
+    color) with least recently used eviction. The surfaces are shared between
+    widgets so callers must only ever blit them.
+    """
+    def __init__(self, max_size=TEXT_CACHE_SIZE):
+        self.MaxSize = max_size
+        self.Surfaces = collections.OrderedDict()
+        self.Hits = 0
+        self.Misses = 0
+
+    def render(self, name, size, text, color):
+        key = (name, size, text, color)
+        surface = self.Surfaces.get(key)
+        if surface is not None:
+            self.Hits += 1
+            self.Surfaces.move_to_end(key)
+            return surface
+
+        self.Misses += 1
+        surface = assets.font(name, size).render(text, 1, color)
+        self.Surfaces[key] = surface
+        if len(self.Surfaces) > self.MaxSize:
+            self.Surfaces.popitem(last=False)
+        return surface
+
+    def stats(self):
+        total = self.Hits + self.Misses
+        rate = 100.0*self.Hits/total if total else 0.0
+        return "%d hits, %d misses (%.1f%%), %d/%d entries"%(self.Hits, self.Misses, rate,
+                                                              len(self.Surfaces), self.MaxSize)
+
+
+TEXT_CACHE = TextCache()
+
+
+def renderText(text, size, color=BLACK, font=FONT_NAME):
+    return TEXT_CACHE.render(font, size, text, color)
+
+
+def boxedSurface(text):
+    # Draw a border around a rendered line of text
+    size = text.get_rect().size
+    base_surface = pygame.surface.Surface(size, pygame.SRCALPHA)
+    base_surface.blit(text, (0,0))
+    border = 2
+    # top line
+    pygame.draw.rect(base_surface, BLACK, [0, 0, size[0], border])
+    # left line
+    pygame.draw.rect(base_surface, BLACK, [0, 0, border, size[1]])
+    # bottom line
+    pygame.draw.rect(base_surface, BLACK, [0, size[1]-border, size[0], size[1]])
+    # right line
+    pygame.draw.rect(base_surface, BLACK, [size[0]-border, 0, size[0], size[1]])
+    return base_surface
+
+
+def widgetName(widget):
+    return getattr(widget, "Name", widget.__class__.__name__)
+
+
+class RenderGroup(object):
+    """
+    Retained mode renderer for a screen of widgets.
+
+    Widgets provide update() which refreshes their state and returns True if
+    they need to be redrawn, a Rect with their current bounds and
+    render(surface). Only the damaged areas are restored from the background
+    and redrawn. render() returns the list of rects to push to the display.
+    An optional perf.Profiler times each widget.
+    """
+    def __init__(self, background, profiler=None):
+        self.Background = background
+        self.Profiler = profiler
+        self.Widgets = []
+        self.Invalid = True
+
+    def add(self, widget):
+        self.Widgets.append(widget)
+
+    def remove(self, widget):
+        self.Widgets.remove(widget)
+        self.invalidate()
+
+    def updateWidget(self, widget):
+        if self.Profiler is None or not self.Profiler.Enabled:
+            return widget.update()
+        t = self.Profiler.begin()
+        changed = widget.update()
+        self.Profiler.end(widgetName(widget) + " update", t)
+        return changed
+
+    def renderWidget(self, widget, surface):
+        if self.Profiler is None or not self.Profiler.Enabled:
+            return widget.render(surface)
+        t = self.Profiler.begin()
+        rect = widget.render(surface)
+        self.Profiler.end(widgetName(widget), t)
+        return rect
+
+    def invalidate(self):
+        # Force a full redraw on the next render (screen switch, wake up)
+        self.Invalid = True
+
+    def render(self, surface):
+        if self.Invalid:
+            self.Invalid = False
+            surface.blit(self.Background, (0,0))
+            for w in self.Widgets:
+                self.updateWidget(w)
+                self.renderWidget(w, surface)
+            return [surface.get_rect()]
+
+        dirty = []
+        damaged = []
+        for w in self.Widgets:
+            old_rect = w.Rect
+            if self.updateWidget(w):
+                dirty.append(w)
+                damaged.append(old_rect)
+                if w.Rect != old_rect:
+                    damaged.append(w.Rect)
+        if not dirty:
+            return []
+
+        # Restoring the background can wipe out parts of neighbouring
+        # widgets, so anything overlapping a damaged area is redrawn too.
+        grown = True
+        while grown:
+            grown = False
+            for w in self.Widgets:
+                if w not in dirty and w.Rect.collidelist(damaged) != -1:
+                    dirty.append(w)
+                    damaged.append(w.Rect)
+                    grown = True
+
+        for r in damaged:
+            surface.blit(self.Background, r, r)
+        for w in self.Widgets:
+            if w in dirty:
+                self.renderWidget(w, surface)
+        return damaged
+
 
 class ImageButton(object):
     ImageFile = None
     def __init__(self, position, handler):
-        self.Image = pygame.image.load(self.ImageFile)
+        self.Image = assets.image(self.ImageFile)
         self.Position = position
         self.Rect = self.Image.get_rect().move(position)
         self.Handler = handler
+        self.Dirty = True
+
+    def update(self):
+        # The image never changes, it only needs drawing after a full redraw
+        return self.Dirty
 
     def render(self, surface, pos=None):
         if pos:
@@ -31,6 +190,8 @@ class ImageButton(object):
             self.Rect = self.Rect.move(pos)
 
         surface.blit(self.Image, self.Position)
+        self.Dirty = False
+        return self.Rect
 
     def handleClick(self, event_pos):
         # print("Rect: %s, pos: %s"%(self.Rect, event_pos))
@@ -63,75 +224,104 @@ class DownButton(ImageButton):
 
 
 class TempAndHumidity(object):
-    def __init__(self, position, data_func, data_args):
+    def __init__(self, position, data_func, data_args, handler=None):
         self.Position = position
         self.DataFunc = data_func
         self.DataArgs = data_args
+        # Called with the sensor name when the badge is tapped
+        self.Handler = handler
+        if data_args:
+            self.Name = str(data_args[0])
 
-        self.Image = pygame.image.load(TEMP_BADGE).convert_alpha()
+        self.Image = assets.image(TEMP_BADGE)
         # self.Image.set_colorkey((0, 0, 0))
         # pygame.Surface.convert_alpha(self.Image)
-        self.Font = pygame.font.SysFont("avenir", 20)
+        self.Rect = self.Image.get_rect().move(position)
+        self.Dirty = True
         self.updateValues()
 
     def updateValues(self):
+        # data_func returns the temperature and humidity text and whether
+        # the readings are stale
         if self.DataFunc:
-            self.Temp, self.Humidity = self.DataFunc(*self.DataArgs)
+            self.Temp, self.Humidity, self.Stale = self.DataFunc(*self.DataArgs)
         else:
             # temp = "%d F"%(t)
             # humidity = "%d %"%(h)
             self.Temp = "76 F"
             self.Humidity = "66 %"
+            self.Stale = False
 
-    def render(self, surface):
+    def update(self):
+        values = (self.Temp, self.Humidity, self.Stale)
         self.updateValues()
+        if (self.Temp, self.Humidity, self.Stale) != values:
+            self.Dirty = True
+        return self.Dirty
+
+    def render(self, surface):
         size = self.Image.get_rect().size
         badge_surface = pygame.surface.Surface(size, pygame.SRCALPHA)
         badge_surface.blit(self.Image, (0,0))
 
 
-        temp_surface = self.Font.render(self.Temp, 1, BLACK)
-        humidity_surface = self.Font.render(self.Humidity, 1, BLACK)
+        color = GREY if self.Stale else BLACK
+        temp_surface = renderText(self.Temp, 20, color)
+        humidity_surface = renderText(self.Humidity, 20, color)
         # TODO: don't hard code the positions
         badge_surface.blit(temp_surface, (11, 7))
         badge_surface.blit(humidity_surface, (10, 26))
 
         surface.blit(badge_surface, self.Position)
+        self.Dirty = False
+        return self.Rect
+
+    def handleClick(self, event_pos):
+        if self.Handler is not None and self.Rect.collidepoint(event_pos):
+            self.Handler(self.Name)
+            return True
+        return False
 
 
 class StartStopButton(object):
-    def __init__(self, position, start_callback, stop_callback):
+    def __init__(self, position, start_callback, stop_callback, anchor=None):
         self.Position = position
         self.On = False
         self.StartCallback = start_callback
         self.StopCallback = stop_callback
-        self.Font = pygame.font.SysFont("avenir", 48)
-
-    def render(self, surface):
+        # Optional widget whose top right corner this button sits against
+        self.Anchor = anchor
+        self.Text = None
+        self.Surface = None
+        self.Rect = pygame.Rect(position, (0, 0))
+
+    def update(self):
+        if self.Anchor is not None:
+            position = self.Anchor.Rect.topright
+        else:
+            position = self.Position
         if self.On:
-            text = self.Font.render(" STOP ", 1, BLACK)
+            text = " STOP "
         else:
-            text = self.Font.render(" START ", 1, BLACK)
-
-        size = text.get_rect().size
-        base_surface = pygame.surface.Surface(size, pygame.SRCALPHA)
-        base_surface.blit(text, (0,0))
-        border = 2
-        # top line
-        pygame.draw.rect(base_surface, BLACK, [0, 0, size[0], border])
-        # left line
-        pygame.draw.rect(base_surface, BLACK, [0, 0, border, size[1]])
-        # bottom line
-        pygame.draw.rect(base_surface, BLACK, [0, size[1]-border, size[0], size[1]])
-        # right line
-        pygame.draw.rect(base_surface, BLACK, [size[0]-border, 0, size[0], size[1]])
-
-        surface.blit(base_surface, self.Position)
-        self.Rectangle = pygame.Rect(self.Position[0], self.Position[1], size[0], size[1])
+            text = " START "
+
+        if text == self.Text and tuple(position) == tuple(self.Position):
+            return False
+
+        if text != self.Text:
+            self.Text = text
+            self.Surface = boxedSurface(renderText(text, 48))
+        self.Position = position
+        self.Rect = self.Surface.get_rect().move(position)
+        return True
+
+    def render(self, surface):
+        surface.blit(self.Surface, self.Position)
+        return self.Rect
 
     def handleClick(self, event_pos):
-        # print("Rect: %s, pos: %s"%(self.Rectangle, event_pos))
-        if self.Rectangle.collidepoint(event_pos):
+        # print("Rect: %s, pos: %s"%(self.Rect, event_pos))
+        if self.Rect.collidepoint(event_pos):
             if self.On:
                 self.On = False
                 self.StopCallback()
@@ -147,7 +337,9 @@ class TimerControl(object):
         self.StopHandler = stop_handler
         self.StartTime = None
         self.Running = False
-        self.Font = pygame.font.SysFont("avenir", 48)
+        self.Text = None
+        self.Surface = None
+        self.Rect = pygame.Rect(position, (0, 0))
 
     def start(self):
         self.StartTime = time.time()
@@ -159,7 +351,14 @@ class TimerControl(object):
         self.Running = False
         self.StopHandler()
 
-    def render(self, surface):
+    def nextUpdate(self):
+        # Time at which the displayed seconds next change
+        if not self.Running:
+            return None
+        elapsed = time.time() - self.StartTime
+        return self.StartTime + int(elapsed) + 1
+
+    def update(self):
         if self.Running:
             elapsed = time.time() - self.StartTime
         else:
@@ -167,19 +366,66 @@ class TimerControl(object):
 
         m, seconds = divmod(elapsed, 60)
         hours, minutes = divmod(m, 60)
-        text = self.Font.render(" %02d:%02d:%02d "%(hours, minutes, seconds), 1, BLACK)
-        size = text.get_rect().size
-        base_surface = pygame.surface.Surface(size, pygame.SRCALPHA)
-        base_surface.blit(text, (0,0))
-        border = 2
-        # top line
-        pygame.draw.rect(base_surface, BLACK, [0, 0, size[0], border])
-        # left line
-        pygame.draw.rect(base_surface, BLACK, [0, 0, border, size[1]])
-        # bottom line
-        pygame.draw.rect(base_surface, BLACK, [0, size[1]-border, size[0], size[1]])
-        # right line
-        pygame.draw.rect(base_surface, BLACK, [size[0]-border, 0, size[0], size[1]])
-
-        surface.blit(base_surface, self.Position)
-        self.Rectangle = base_surface.get_rect()
+        text = " %02d:%02d:%02d "%(hours, minutes, seconds)
+        if text == self.Text:
+            return False
+
+        self.Text = text
+        self.Surface = boxedSurface(renderText(text, 48))
+        self.Rect = self.Surface.get_rect().move(self.Position)
+        return True
+
+    def render(self, surface):
+        surface.blit(self.Surface, self.Position)
+        return self.Rect
+
+
+class PerfOverlay(object):
+    """
+    Shows the frame rate and the slowest timings of a perf.Profiler, refreshed
+    at most once a second. status returns more lines to show below them.
+    """
+    Name = "perf overlay"
+    def __init__(self, position, profiler, lines=4, status=None):
+        self.Position = position
+        self.Profiler = profiler
+        self.Lines = lines
+        self.Status = status
+        self.Text = None
+        self.Surface = None
+        self.Rect = pygame.Rect(position, (0, 0))
+        self.LastUpdate = 0
+
+    def update(self):
+        now = time.time()
+        if self.Surface is not None and now - self.LastUpdate < 1:
+            return False
+        self.LastUpdate = now
+
+        frame = self.Profiler.Timings.get("frame")
+        frame_p95 = frame.summary()[1] if frame else 0
+        lines = ["%.1f fps, frame p95 %.1f ms"%(self.Profiler.fps(), 1000*frame_p95)]
+        for name, stats in self.Profiler.slowest(self.Lines):
+            lines.append("%s %.1f/%.1f/%.1f"%((name,) + tuple(1000*t for t in stats)))
+        if self.Status is not None:
+            lines.extend(self.Status())
+        text = "\n".join(lines)
+        if text == self.Text:
+            return False
+
+        self.Text = text
+        rendered = [renderText(l, 16) for l in lines]
+        width = max(r.get_width() for r in rendered) + 8
+        height = sum(r.get_height() for r in rendered) + 8
+        self.Surface = pygame.surface.Surface((width, height), pygame.SRCALPHA)
+        self.Surface.fill((255, 255, 255, 200))
+        y = 4
+        for r in rendered:
+            self.Surface.blit(r, (4, y))
+            y += r.get_height()
+        self.Rect = self.Surface.get_rect().move(self.Position)
+        return True
+
+    def render(self, surface):
+        surface.blit(self.Surface, self.Position)
+        return self.Rect